@@ -1,8 +1,10 @@
 from dynet import *
-from utils import ParseForest, read_conll, write_conll
+from utils import ArcHybridState, ArcHybridOracle, read_conll, write_conll
+from encoder import BiLSTMEncoder
 from operator import itemgetter
-from itertools import chain
-import utils, time, random
+from itertools import chain, islice
+from collections import Counter
+import utils, os, time, random, heapq
 import numpy as np
 
 
@@ -14,8 +16,15 @@ class ArcHybridLSTM:
 
         self.activations = {'tanh': tanh, 'sigmoid': logistic, 'relu': rectify, 'tanh3': (lambda x: tanh(cwise_multiply(cwise_multiply(x, x), x)))}
         self.activation = self.activations[options.activation]
+        self.npactivations = {'tanh': np.tanh, 'sigmoid': (lambda x: 1.0 / (1.0 + np.exp(-x))), 'relu': (lambda x: np.maximum(x, 0.0)), 'tanh3': (lambda x: np.tanh(x * x * x))}
+        self.npactivation = self.npactivations[options.activation]
 
         self.oracle = options.oracle
+        self.predictBatch = getattr(options, 'predict_batch', 1)
+        # Batches read and indexed ahead of the one being parsed or trained on.
+        self.prefetch = getattr(options, 'prefetch', 4)
+        self.timer = utils.StageTimer()
+        self.beam = getattr(options, 'beam', 1)
         self.ldims = options.lstm_dims * 2
         self.wdims = options.wembedding_dims
         self.pdims = options.pembedding_dims
@@ -34,19 +43,32 @@ class ArcHybridLSTM:
 
         self.nnvecs = (1 if self.headFlag else 0) + (2 if self.rlFlag or self.rlMostFlag else 0)
 
+        # Transition and relation of every routLayer output: shift, then left/right arcs per relation.
+        self.candTransitions = np.array([2] + [0, 1] * len(rels))
+        self.candRels = np.array([-1] + [j for j in xrange(len(rels)) for _ in xrange(2)])
+        # outLayer row scoring each candidate: shift is row 0, left arc row 1, right arc row 2.
+        self.candOutputs = (self.candTransitions + 1) % 3
+
         self.external_embedding = None
+        self.extrnIndex, self.extrnRows = None, None
         if options.external_embedding is not None:
-            external_embedding_fp = open(options.external_embedding,'r')
-            external_embedding_fp.readline()
-            self.external_embedding = {line.split(' ')[0] : [float(f) for f in line.strip().split(' ')[1:]] for line in external_embedding_fp}
-            external_embedding_fp.close()
-
-            self.edim = len(self.external_embedding.values()[0])
+            if getattr(options, 'extrn_words', None) is None:
+                self.external_embedding, vectors = utils.load_embeddings(options.external_embedding)
+            else:
+                # elookup holds the given words only. For a vocabulary-restricted model,
+                # Predict finds the other words through the on-disk index of the embedding
+                # file. Without the file (e.g. a bundle), the rows are loaded with the model.
+                self.external_embedding, vectors = options.extrn_words, None
+                if getattr(options, 'extrnRestrict', False) and os.path.exists(options.external_embedding):
+                    self.extrnIndex = utils.EmbeddingIndex(options.external_embedding)
+                    vectors = self.extrnIndex.vectors[[self.extrnIndex.row(word) for word in self.external_embedding]]
+
+            self.edim = vectors.shape[1] if vectors is not None else options.extrn_dims
             self.noextrn = [0.0 for _ in xrange(self.edim)]
             self.extrnd = {word: i + 3 for i, word in enumerate(self.external_embedding)}
             self.elookup = self.model.add_lookup_parameters((len(self.external_embedding) + 3, self.edim))
-            for word, i in self.extrnd.iteritems():
-                self.elookup.init_row(i, self.external_embedding[word])
+            if vectors is not None:
+                self.elookup.init_from_array(np.concatenate([[self.elookup.row_as_array(i) for i in xrange(3)], vectors]))
             self.extrnd['*PAD*'] = 1
             self.extrnd['*INITIAL*'] = 2
 
@@ -102,52 +124,84 @@ class ArcHybridLSTM:
         self.routLayer = self.model.add_parameters((2 * (len(self.irels) + 0) + 1, self.hidden2_units if self.hidden2_units > 0 else self.hidden_units))
         self.routBias = self.model.add_parameters((2 * (len(self.irels) + 0) + 1))
 
+        lookups = [self.wlookup] + ([self.plookup] if self.pdims > 0 else []) + ([self.elookup] if self.external_embedding is not None else [])
+        self.encoder = BiLSTMEncoder(lookups, self.surfaceBuilders if self.blstmFlag else None, self.bsurfaceBuilders if self.blstmFlag and self.bibiFlag else None)
 
-    def __evaluate(self, stack, buf, train):
-        topStack = [ stack.roots[-i-1].lstms if len(stack) > i else [self.empty] for i in xrange(self.k) ]
-        topBuffer = [ buf.roots[i].lstms if len(buf) > i else [self.empty] for i in xrange(1) ]
 
-        input = concatenate(list(chain(*(topStack + topBuffer))))
+    def __featureIndices(self, state, padding, offset=0):
+        # Index of the token vector feeding every (slot, vector) block of the first layer:
+        # the k top stack items then the buffer head, padding for empty slots. Token
+        # positions are shifted by offset when several sentences share the projections.
+        indices = []
+        for i in xrange(self.k):
+            indices.extend(state.vecs[state.stack[state.size-i-1]] + offset if state.size > i else [padding] * self.nnvecs)
+        indices.extend(state.vecs[state.bufferHead] + offset if state.bufferHead < state.n else [padding] * self.nnvecs)
+        return indices
 
-        if self.hidden2_units > 0:
-            routput = (self.routLayer.expr() * self.activation(self.rhid2Bias.expr() + self.rhid2Layer.expr() * self.activation(self.rhidLayer.expr() * input + self.rhidBias.expr())) + self.routBias.expr())
-        else:
-            routput = (self.routLayer.expr() * self.activation(self.rhidLayer.expr() * input + self.rhidBias.expr()) + self.routBias.expr())
 
-        if self.hidden2_units > 0:
-            output = (self.outLayer.expr() * self.activation(self.hid2Bias.expr() + self.hid2Layer.expr() * self.activation(self.hidLayer.expr() * input + self.hidBias.expr())) + self.outBias.expr())
-        else:
-            output = (self.outLayer.expr() * self.activation(self.hidLayer.expr() * input + self.hidBias.expr()) + self.outBias.expr())
+    def __precompute(self, vecs_list):
+        # Project every token vector, plus the padding vector as the last column, through
+        # the block of the fused first layer that each (slot, vector) feature multiplies.
+        # A transition then only sums k+1 cached columns per vector.
+        vecs = concatenate_cols(vecs_list + [self.paddingVec])
+        return [block * vecs for block in self.firstBlocks]
 
-        scrs, uscrs = routput.value(), output.value()
 
+    def __transitions(self, state, scrs, uscrs):
         #transition conditions
-        left_arc_conditions = len(stack) > 0 and len(buf) > 0
-        right_arc_conditions = len(stack) > 1 and stack.roots[-1].id != 0
-        shift_conditions = len(buf) >0 and buf.roots[0].id != 0
+        left_arc_conditions = state.canLeftArc()
+        right_arc_conditions = state.canRightArc()
+        shift_conditions = state.canShift()
 
         uscrs0 = uscrs[0]
         uscrs1 = uscrs[1]
         uscrs2 = uscrs[2]
-        if train:
-            output0 = output[0]
-            output1 = output[1]
-            output2 = output[2]
-            ret = [ [ (rel, 0, scrs[1 + j * 2] + uscrs1, routput[1 + j * 2 ] + output1) for j, rel in enumerate(self.irels) ] if left_arc_conditions else [],
-                    [ (rel, 1, scrs[2 + j * 2] + uscrs2, routput[2 + j * 2 ] + output2) for j, rel in enumerate(self.irels) ] if right_arc_conditions else [],
-                    [ (None, 2, scrs[0] + uscrs0, routput[0] + output0) ] if shift_conditions else [] ]
-        else:
-            s1,r1 = max(zip(scrs[1::2],self.irels))
-            s2,r2 = max(zip(scrs[2::2],self.irels))
-            s1 += uscrs1
-            s2 += uscrs2
-            ret = [ [ (r1, 0, s1) ] if left_arc_conditions else [],
-                    [ (r2, 1, s2) ] if right_arc_conditions else [],
-                    [ (None, 2, scrs[0] + uscrs0) ] if shift_conditions else [] ]
+        s1,r1 = max(zip(scrs[1::2],self.irels))
+        s2,r2 = max(zip(scrs[2::2],self.irels))
+        s1 += uscrs1
+        s2 += uscrs2
+        ret = [ [ (r1, 0, s1) ] if left_arc_conditions else [],
+                [ (r2, 1, s2) ] if right_arc_conditions else [],
+                [ (None, 2, scrs[0] + uscrs0) ] if shift_conditions else [] ]
         return ret
-        #return [ [ (rel, 0, scrs[1 + j * 2 + 0] + uscrs[1], routput[1 + j * 2 + 0] + output[1]) for j, rel in enumerate(self.irels) ] if len(stack) > 0 and len(buf) > 0 else [],
-        #         [ (rel, 1, scrs[1 + j * 2 + 1] + uscrs[2], routput[1 + j * 2 + 1] + output[2]) for j, rel in enumerate(self.irels) ] if len(stack) > 1 else [],
-        #         [ (None, 2, scrs[0] + uscrs[0], routput[0] + output[0]) ] if len(buf) > 0 else [] ]
+
+
+    def __evaluate(self, indices, projections):
+        # Differentiable routLayer/outLayer scores of one state, given its feature indices.
+        hidden = self.activation(esum([pick(projection, index, 1) for projection, index in zip(projections, indices)]) + self.firstBias)
+        rhidden = pickrange(hidden, self.hidden_units, 2 * self.hidden_units)
+        hidden = pickrange(hidden, 0, self.hidden_units)
+
+        if self.hidden2_units > 0:
+            routput = (self.routLayer.expr() * self.activation(self.rhid2Bias.expr() + self.rhid2Layer.expr() * rhidden) + self.routBias.expr())
+            output = (self.outLayer.expr() * self.activation(self.hid2Bias.expr() + self.hid2Layer.expr() * hidden) + self.outBias.expr())
+        else:
+            routput = (self.routLayer.expr() * rhidden + self.routBias.expr())
+            output = (self.outLayer.expr() * hidden + self.outBias.expr())
+
+        return routput, output
+
+
+    def __evaluateNumeric(self, indices, projections):
+        # Same scores as __evaluate, from the projection values, as NumPy vectors.
+        first = projections[np.arange(len(indices)), :, indices].sum(axis=0)
+        scrs, uscrs = self.__mlpNumeric(first[:, None])
+        return scrs[:, 0], uscrs[:, 0]
+
+
+    def __mlpNumeric(self, first):
+        # NumPy forward pass of both heads above the fused first layer, one column per state.
+        params = self.npParams
+        hidden = self.npactivation(first + params['firstBias'][:, None])
+        rhidden = hidden[self.hidden_units:]
+        hidden = hidden[:self.hidden_units]
+
+        if self.hidden2_units > 0:
+            rhidden = self.npactivation(params['rhid2Layer'].dot(rhidden) + params['rhid2Bias'][:, None])
+            hidden = self.npactivation(params['hid2Layer'].dot(hidden) + params['hid2Bias'][:, None])
+
+        return (params['routLayer'].dot(rhidden) + params['routBias'][:, None],
+                params['outLayer'].dot(hidden) + params['outBias'][:, None])
 
 
     def Save(self, filename):
@@ -162,116 +216,176 @@ class ArcHybridLSTM:
         paddingWordVec = self.wlookup[1]
         paddingPosVec = self.plookup[1] if self.pdims > 0 else None
 
-        paddingVec = tanh(self.word2lstm.expr() * concatenate(filter(None, [paddingWordVec, paddingPosVec, evec])) + self.word2lstmbias.expr() )
-        self.empty = paddingVec if self.nnvecs == 1 else concatenate([paddingVec for _ in xrange(self.nnvecs)])
-
-
-    def getWordEmbeddings(self, sentence, train):
-        for root in sentence:
-            c = float(self.wordsCount.get(root.norm, 0))
-            dropFlag =  not train or (random.random() < (c/(0.25+c)))
-            root.wordvec = self.wlookup[int(self.vocab.get(root.norm, 0)) if dropFlag else 0]
-            root.posvec = self.plookup[int(self.pos[root.pos])] if self.pdims > 0 else None
-
-            if self.external_embedding is not None:
-                #if not dropFlag and random.random() < 0.5:
-                #    root.evec = self.elookup[0]
-                if root.form in self.external_embedding:
-                    root.evec = self.elookup[self.extrnd[root.form]]
-                elif root.norm in self.external_embedding:
-                    root.evec = self.elookup[self.extrnd[root.norm]]
-                else:
-                    root.evec = self.elookup[0]
-            else:
-                root.evec = None
-            root.ivec = concatenate(filter(None, [root.wordvec, root.posvec, root.evec]))
-
-        if self.blstmFlag:
-            forward  = self.surfaceBuilders[0].initial_state()
-            backward = self.surfaceBuilders[1].initial_state()
-
-            for froot, rroot in zip(sentence, reversed(sentence)):
-                forward = forward.add_input( froot.ivec )
-                backward = backward.add_input( rroot.ivec )
-                froot.fvec = forward.output()
-                rroot.bvec = backward.output()
-            for root in sentence:
-                root.vec = concatenate( [root.fvec, root.bvec] )
-
-            if self.bibiFlag:
-                bforward  = self.bsurfaceBuilders[0].initial_state()
-                bbackward = self.bsurfaceBuilders[1].initial_state()
-
-                for froot, rroot in zip(sentence, reversed(sentence)):
-                    bforward = bforward.add_input( froot.vec )
-                    bbackward = bbackward.add_input( rroot.vec )
-                    froot.bfvec = bforward.output()
-                    rroot.bbvec = bbackward.output()
-                for root in sentence:
-                    root.vec = concatenate( [root.bfvec, root.bbvec] )
+        self.paddingVec = tanh(self.word2lstm.expr() * concatenate(filter(None, [paddingWordVec, paddingPosVec, evec])) + self.word2lstmbias.expr() )
 
-        else:
-            for root in sentence:
-                root.ivec = (self.word2lstm.expr() * root.ivec) + self.word2lstmbias.expr()
-                root.vec = tanh( root.ivec )
+        # hidLayer and rhidLayer share their input, so they run as one fused matrix
+        # split into the column block of every (slot, vector) feature.
+        first = concatenate([self.hidLayer.expr(), self.rhidLayer.expr()])
+        self.firstBlocks = [select_cols(first, range(b * self.ldims, (b + 1) * self.ldims)) for b in xrange((self.k + 1) * self.nnvecs)]
+        self.firstBias = concatenate([self.hidBias.expr(), self.rhidBias.expr()])
 
+        names = ['routLayer', 'routBias', 'outLayer', 'outBias'] + (['rhid2Layer', 'rhid2Bias', 'hid2Layer', 'hid2Bias'] if self.hidden2_units > 0 else [])
+        self.npParams = {name: getattr(self, name).as_array() for name in names}
+        self.npParams['firstBias'] = self.firstBias.npvalue()
 
-    def Predict(self, conll_path):
-        with open(conll_path, 'r') as conllFP:
-            for iSentence, sentence in enumerate(read_conll(conllFP, False)):
-                self.Init()
 
-                conll_sentence = [entry for entry in sentence if isinstance(entry, utils.ConllEntry)]
+    def __indices(self, words, pos, extrn, keep):
+        # Lookup indices (one column per embedding table) and keep probabilities of the
+        # tokens of a sentence; in training a word is replaced by the unknown index with
+        # probability 1 - keep.
+        indices = [words] + ([pos] if self.pdims > 0 else []) + ([extrn] if self.external_embedding is not None else [])
+        return np.array(indices).T, np.array([keep] + [np.ones(len(keep))] * (len(indices) - 1)).T
 
-                conll_sentence = conll_sentence[1:] + [conll_sentence[0]]
-                self.getWordEmbeddings(conll_sentence, False)
-                stack = ParseForest([])
-                buf = ParseForest(conll_sentence)
 
-                for root in conll_sentence:
-                    root.lstms = [root.vec for _ in xrange(self.nnvecs)]
+    def getWordEmbeddings(self, indices_list, keep_list=None, lookups=None):
+        # Token vectors of every sentence as ldims x n matrices.
+        vecs_list = self.encoder.encode(indices_list, keep_list, lookups)
+        if not self.blstmFlag:
+            vecs_list = [tanh(self.word2lstm.expr() * vecs + self.word2lstmbias.expr()) for vecs in vecs_list]
 
-                hoffset = 1 if self.headFlag else 0
+        return vecs_list
 
-                while not (len(buf) == 1 and len(stack) == 0):
-                    scores = self.__evaluate(stack, buf, False)
-                    best = max(chain(*scores), key = itemgetter(2) )
 
-                    if best[1] == 2:
-                        stack.roots.append(buf.roots[0])
-                        del buf.roots[0]
+    def __apply(self, state, transition, rel):
+        # Apply a transition (rel is a relation index) and update the rightmost/leftmost
+        # child features of the parent.
+        arc = state.apply(transition, rel)
+        if arc is not None:
+            child, parent = arc
+            slot = transition + (1 if self.headFlag else 0)
+            if self.rlMostFlag:
+                state.vecs[parent, slot] = state.vecs[child, slot]
+            if self.rlFlag:
+                state.vecs[parent, slot] = child
+        return arc
 
-                    elif best[1] == 0:
-                        child = stack.roots.pop()
-                        parent = buf.roots[0]
 
-                        child.pred_parent_id = parent.id
-                        child.pred_relation = best[0]
+    def __extrn(self, form, norm):
+        if self.extrnRows is not None:
+            return self.extrnRows.get(form, norm)
+        return self.extrnd.get(form, self.extrnd.get(norm, 0))
 
-                        bestOp = 0
-                        if self.rlMostFlag:
-                            parent.lstms[bestOp + hoffset] = child.lstms[bestOp + hoffset]
-                        if self.rlFlag:
-                            parent.lstms[bestOp + hoffset] = child.vec
 
-                    elif best[1] == 1:
-                        child = stack.roots.pop()
-                        parent = stack.roots[-1]
+    def InitExternal(self):
+        # Words missing from a restricted elookup get rows as the input needs them; called
+        # before parsing with the current parameter values.
+        self.extrnRows = utils.ExternalRows(self.extrnd, self.elookup.as_array(), self.extrnIndex) if self.extrnIndex is not None else None
 
-                        child.pred_parent_id = parent.id
-                        child.pred_relation = best[0]
 
-                        bestOp = 1
-                        if self.rlMostFlag:
-                            parent.lstms[bestOp + hoffset] = child.lstms[bestOp + hoffset]
-                        if self.rlFlag:
-                            parent.lstms[bestOp + hoffset] = child.vec
+    def Indices(self, forms, tags):
+        # Lookup indices of a sentence given the forms and POS tags of its words; the root
+        # takes the last position.
+        forms = list(forms) + ['*root*']
+        norms = [utils.normalize(form) for form in forms]
+        tags = [tag.upper() for tag in tags] + ['ROOT-POS']
+        return self.__indices([self.vocab.get(norm, 0) for norm in norms],
+                              [self.pos.get(tag, 0) for tag in tags],
+                              [self.__extrn(form, norm) for form, norm in zip(forms, norms)] if self.external_embedding is not None else None,
+                              np.ones(len(forms)))[0]
 
-                renew_cg()
+
+    def Parse(self, indices_list):
+        # Heads (0 is the root) and relation indices of the words of every sentence, given
+        # as Indices arrays. The batch is parsed in lockstep: every step scores the beam
+        # items of all unfinished sentences with one matrix forward pass. A beam of 1 is
+        # greedy decoding.
+        if not indices_list:
+            return [], []
+
+        self.Init()
+
+        projections = np.array([projection.npvalue() for projection in self.__precompute(self.getWordEmbeddings(indices_list, lookups=self.encoder.lookups[:-1] + [self.extrnRows.matrix] if self.extrnRows is not None else None))])
+        blocks = np.arange(len(projections))[None, :]
+        padding = projections.shape[2] - 1
+        offsets = np.cumsum([0] + [len(indices) for indices in indices_list])
+        beams = [[(0.0, ArcHybridState(len(indices), self.nnvecs))] for indices in indices_list]
+        active = [i for i, beam in enumerate(beams) if not beam[0][1].isFinal()]
+
+        while active:
+            items = [(i, score, state) for i in active for score, state in beams[i]]
+            indices = np.array([self.__featureIndices(state, padding, offsets[i]) for i, score, state in items])
+            scrs, uscrs = self.__mlpNumeric(projections[blocks, :, indices].sum(axis=1).T)
+
+            candidates = dict((i, []) for i in active)
+            for column, (i, score, state) in enumerate(items):
+                for rel, transition, scr in chain(*self.__transitions(state, scrs[:, column], uscrs[:, column])):
+                    candidates[i].append((score + scr, state, transition, rel))
+
+            for i in active:
+                beams[i] = self.__advance(heapq.nlargest(self.beam, candidates[i], key=itemgetter(0)))
+
+            active = [i for i in active if not beams[i][0][1].isFinal()]
+
+        renew_cg()
+        # Head positions become ids: the root (last position) is 0, word i is i + 1.
+        states = [beam[0][1] for beam in beams]
+        return [(state.heads[:-1] + 1) % state.n for state in states], [state.rels[:-1] for state in states]
+
+
+    def Predict(self, conll_path):
+        self.InitExternal()
+
+        with open(conll_path, 'r') as conllFP:
+            for parsed in self.PredictSentences(read_conll(conllFP, False)):
+                yield parsed
+
+
+    def PredictSentences(self, sentences):
+        # Parse read_conll sentences in batches of predictBatch, filling their predictions.
+        # The next batches are read and indexed on a background thread meanwhile.
+        for batch, indices_list, done in utils.prefetch(self.__indexBatches(sentences), self.prefetch, self.timer):
+            ts = time.time()
+            self.__predictBatch(batch, indices_list)
+            self.timer.add('parse', time.time() - ts)
+            for sentence in done:
                 yield sentence
 
 
-    def Train(self, conll_path):
+    def __indexBatches(self, sentences, pool=8):
+        # Sentences are read in pools of pool batches and batched by length within a pool,
+        # so that little padding is encoded. The last batch of a pool comes with all the
+        # sentences of the pool, in input order, to be yielded once it is parsed.
+        sentences = iter(sentences)
+        while True:
+            pooled = list(islice(sentences, self.predictBatch * pool))
+            if not pooled:
+                break
+            order = sorted(pooled, key=len)
+            batches = [order[i:i + self.predictBatch] for i in xrange(0, len(order), self.predictBatch)]
+            for b, batch in enumerate(batches):
+                yield batch, self.__batchIndices(batch), pooled if b == len(batches) - 1 else []
+
+
+    def __batchIndices(self, batch):
+        conll_sentences = [[entry for entry in sentence if isinstance(entry, utils.ConllEntry)][1:] for sentence in batch]
+        return [self.Indices([entry.form for entry in conll_sentence], [entry.pos for entry in conll_sentence]) for conll_sentence in conll_sentences]
+
+
+    def __predictBatch(self, batch, indices_list):
+        conll_sentences = [[entry for entry in sentence if isinstance(entry, utils.ConllEntry)][1:] for sentence in batch]
+        heads_list, rels_list = self.Parse(indices_list)
+
+        for conll_sentence, heads, rels in zip(conll_sentences, heads_list, rels_list):
+            for entry, head, rel in zip(conll_sentence, heads, rels):
+                entry.pred_parent_id = head
+                entry.pred_relation = self.irels[rel]
+
+
+    def __advance(self, candidates):
+        # Apply the chosen (score, state, transition, rel) candidates; a state is only
+        # copied when more than one candidate extends it.
+        uses = Counter(id(state) for score, state, transition, rel in candidates)
+        beam = []
+        for score, state, transition, rel in candidates:
+            uses[id(state)] -= 1
+            if uses[id(state)] > 0:
+                state = state.copy()
+            self.__apply(state, transition, self.rels[rel] if rel is not None else -1)
+            beam.append((score, state))
+        return beam
+
+
+    def Train(self, corpus):
         mloss = 0.0
         errors = 0
         batch = 0
@@ -282,118 +396,85 @@ class ArcHybridLSTM:
         ltotal = 0
         ninf = -float('inf')
 
-        hoffset = 1 if self.headFlag else 0
-
         start = time.time()
 
-        with open(conll_path, 'r') as conllFP:
-            shuffledData = list(read_conll(conllFP, True))
-            random.shuffle(shuffledData)
+        # External embedding rows of the distinct word forms of the corpus.
+        extrn = np.array([self.extrnd.get(form, self.extrnd.get(utils.normalize(form), 0)) for form in corpus.forms]) if self.external_embedding is not None else None
+        shuffledData = range(len(corpus))
+        random.shuffle(shuffledData)
+
+        errs = []
+        eeloss = 0.0
+
+        self.Init()
+
+        self.timer.reset()
+        for iSentence, (n, tokens, keep, goldHeads, goldRels) in enumerate(utils.prefetch(self.__trainSentences(corpus, shuffledData, extrn), self.prefetch, self.timer)):
+            ts = time.time()
+            if iSentence % 100 == 0 and iSentence != 0:
+                print 'Processing sentence number:', iSentence, 'Loss:', eloss / etotal, 'Errors:', (float(eerrors)) / etotal, 'Labeled Errors:', (float(lerrors) / etotal) , 'Time', time.time()-start
+                start = time.time()
+                eerrors = 0
+                eloss = 0.0
+                etotal = 0
+                lerrors = 0
+                ltotal = 0
+
+            projections = self.__precompute(self.getWordEmbeddings([tokens], [keep]))
+            pvalues = np.array([projection.npvalue() for projection in projections])
+            state = ArcHybridState(n, self.nnvecs)
+
+            oracle = ArcHybridOracle(goldHeads)
+
+            while not state.isFinal():
+                # Candidate scores stay in NumPy; expressions are only built for a violated margin.
+                indices = self.__featureIndices(state, n)
+                scrs, uscrs = self.__evaluateNumeric(indices, pvalues)
+                scores = scrs + uscrs[self.candOutputs]
+
+                s0 = state.stack[state.size-1] if state.size > 0 else -1
+                costs = np.array(oracle.costs(state))
+                allowed = np.array([state.canLeftArc(), state.canRightArc(), state.canShift()])[self.candTransitions]
+                valid = allowed & (costs[self.candTransitions] == 0) & ((self.candTransitions == 2) | (self.candRels == goldRels[s0]))
+                wrong = allowed & ~valid
+
+                bestValid = int(np.argmax(np.where(valid, scores, ninf)))
+                bestWrong = int(np.argmax(np.where(wrong, scores, ninf)))
+                validScore = scores[bestValid]
+                wrongScore = scores[bestWrong] if wrong[bestWrong] else ninf
+                best = bestValid if ( (not self.oracle) or (validScore - wrongScore > 1.0) or (validScore > wrongScore and random.random() > 0.1) ) else bestWrong
+
+                if validScore < wrongScore + 1.0:
+                    routput, output = self.__evaluate(indices, projections)
+                    loss = (pick(routput, bestWrong) + pick(output, int(self.candOutputs[bestWrong]))) - (pick(routput, bestValid) + pick(output, int(self.candOutputs[bestValid])))
+                    mloss += 1.0 + wrongScore - validScore
+                    eloss += 1.0 + wrongScore - validScore
+                    errs.append(loss)
+
+                oracle.apply(state, self.candTransitions[best])
+                arc = self.__apply(state, self.candTransitions[best], self.candRels[best])
+
+                if arc is not None and (arc[1] != goldHeads[arc[0]] or self.candRels[best] != goldRels[arc[0]]):
+                    lerrors += 1
+                    if arc[1] != goldHeads[arc[0]]:
+                        errors += 1
+                        eerrors += 1
+
+                etotal += 1
+
+            if len(errs) > 50: # or True:
+                #eerrs = ((esum(errs)) * (1.0/(float(len(errs)))))
+                eerrs = esum(errs)
+                scalar_loss = eerrs.scalar_value()
+                eerrs.backward()
+                self.trainer.update()
+                errs = []
+                lerrs = []
 
-            errs = []
-            eeloss = 0.0
-
-            self.Init()
-
-            for iSentence, sentence in enumerate(shuffledData):
-                if iSentence % 100 == 0 and iSentence != 0:
-                    print 'Processing sentence number:', iSentence, 'Loss:', eloss / etotal, 'Errors:', (float(eerrors)) / etotal, 'Labeled Errors:', (float(lerrors) / etotal) , 'Time', time.time()-start
-                    start = time.time()
-                    eerrors = 0
-                    eloss = 0.0
-                    etotal = 0
-                    lerrors = 0
-                    ltotal = 0
-
-                conll_sentence = [entry for entry in sentence if isinstance(entry, utils.ConllEntry)]
-
-                conll_sentence = conll_sentence[1:] + [conll_sentence[0]]
-                self.getWordEmbeddings(conll_sentence, True)
-                stack = ParseForest([])
-                buf = ParseForest(conll_sentence)
-
-                for root in conll_sentence:
-                    root.lstms = [root.vec for _ in xrange(self.nnvecs)]
-
-                hoffset = 1 if self.headFlag else 0
-
-                while not (len(buf) == 1 and len(stack) == 0):
-                    scores = self.__evaluate(stack, buf, True)
-                    scores.append([(None, 3, ninf ,None)])
-
-                    alpha = stack.roots[:-2] if len(stack) > 2 else []
-                    s1 = [stack.roots[-2]] if len(stack) > 1 else []
-                    s0 = [stack.roots[-1]] if len(stack) > 0 else []
-                    b = [buf.roots[0]] if len(buf) > 0 else []
-                    beta = buf.roots[1:] if len(buf) > 1 else []
-
-                    left_cost  = ( len([h for h in s1 + beta if h.id == s0[0].parent_id]) +
-                                   len([d for d in b + beta if d.parent_id == s0[0].id]) )  if len(scores[0]) > 0 else 1
-                    right_cost = ( len([h for h in b + beta if h.id == s0[0].parent_id]) +
-                                   len([d for d in b + beta if d.parent_id == s0[0].id]) )  if len(scores[1]) > 0 else 1
-                    shift_cost = ( len([h for h in s1 + alpha if h.id == b[0].parent_id]) +
-                                   len([d for d in s0 + s1 + alpha if d.parent_id == b[0].id]) )  if len(scores[2]) > 0 else 1
-                    costs = (left_cost, right_cost, shift_cost, 1)
-
-                    bestValid = max(( s for s in chain(*scores) if costs[s[1]] == 0 and ( s[1] == 2 or  s[0] == stack.roots[-1].relation ) ), key=itemgetter(2))
-                    bestWrong = max(( s for s in chain(*scores) if costs[s[1]] != 0 or  ( s[1] != 2 and s[0] != stack.roots[-1].relation ) ), key=itemgetter(2))
-                    best = bestValid if ( (not self.oracle) or (bestValid[2] - bestWrong[2] > 1.0) or (bestValid[2] > bestWrong[2] and random.random() > 0.1) ) else bestWrong
-
-                    if best[1] == 2:
-                        stack.roots.append(buf.roots[0])
-                        del buf.roots[0]
-
-                    elif best[1] == 0:
-                        child = stack.roots.pop()
-                        parent = buf.roots[0]
-
-                        child.pred_parent_id = parent.id
-                        child.pred_relation = best[0]
-
-                        bestOp = 0
-                        if self.rlMostFlag:
-                            parent.lstms[bestOp + hoffset] = child.lstms[bestOp + hoffset]
-                        if self.rlFlag:
-                            parent.lstms[bestOp + hoffset] = child.vec
-
-                    elif best[1] == 1:
-                        child = stack.roots.pop()
-                        parent = stack.roots[-1]
-
-                        child.pred_parent_id = parent.id
-                        child.pred_relation = best[0]
-
-                        bestOp = 1
-                        if self.rlMostFlag:
-                            parent.lstms[bestOp + hoffset] = child.lstms[bestOp + hoffset]
-                        if self.rlFlag:
-                            parent.lstms[bestOp + hoffset] = child.vec
-
-                    if bestValid[2] < bestWrong[2] + 1.0:
-                        loss = bestWrong[3] - bestValid[3]
-                        mloss += 1.0 + bestWrong[2] - bestValid[2]
-                        eloss += 1.0 + bestWrong[2] - bestValid[2]
-                        errs.append(loss)
-
-                    if best[1] != 2 and (child.pred_parent_id != child.parent_id or child.pred_relation != child.relation):
-                        lerrors += 1
-                        if child.pred_parent_id != child.parent_id:
-                            errors += 1
-                            eerrors += 1
-
-                    etotal += 1
-
-                if len(errs) > 50: # or True:
-                    #eerrs = ((esum(errs)) * (1.0/(float(len(errs)))))
-                    eerrs = esum(errs)
-                    scalar_loss = eerrs.scalar_value()
-                    eerrs.backward()
-                    self.trainer.update()
-                    errs = []
-                    lerrs = []
-
-                    renew_cg()
-                    self.Init()
+                renew_cg()
+                self.Init()
+
+            self.timer.add('train', time.time() - ts)
 
         if len(errs) > 0:
             eerrs = (esum(errs)) # * (1.0/(float(len(errs))))
@@ -408,3 +489,17 @@ class ArcHybridLSTM:
 
         self.trainer.update_epoch()
         print "Loss: ", mloss/iSentence
+        print 'Stage times:', self.timer
+
+
+    def __trainSentences(self, corpus, order, extrn):
+        # Length, lookup indices, keep probabilities and gold heads and relations of the
+        # sentences in the given order. Positions move the root (stored first) to the end
+        # of the sentence, and gold heads are positions too.
+        for i in order:
+            span = corpus.span(i)
+            n = span.stop - span.start
+            positions = np.roll(np.arange(n), -1)
+            tokens, keep = self.__indices(corpus.word[span][positions], corpus.pos[span][positions], extrn[corpus.form[span][positions]] if extrn is not None else None, corpus.keep[span][positions])
+            heads = corpus.head[span][positions]
+            yield n, tokens, keep, np.where(heads >= 0, (heads - 1) % n, -1), corpus.rel[span][positions]
@@ -0,0 +1,44 @@
+from optparse import OptionParser
+from arc_hybrid import ArcHybridLSTM
+import pickle, utils, time
+
+# Parse an annotated file with a trained model at several beam widths and report
+# throughput against attachment scores (all tokens, punctuation included).
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--test", dest="conll_test", help="Annotated CONLL test file", metavar="FILE", default="../data/PTB_SD_3_3_0/test.conll")
+    parser.add_option("--params", dest="params", help="Parameters file", metavar="FILE", default="params.pickle")
+    parser.add_option("--extrn", dest="external_embedding", help="External embeddings", metavar="FILE")
+    parser.add_option("--model", dest="model", help="Load model file", metavar="FILE", default="barchybrid.model")
+    parser.add_option("--beams", type="string", dest="beams", default="1,2,4,8")
+    parser.add_option("--predict-batch", type="int", dest="predict_batch", default=32)
+    parser.add_option("--dynet-seed", type="int", dest="seed", default=7)
+    parser.add_option("--dynet-mem", type="int", dest="cnn_mem", default=512)
+
+    (options, args) = parser.parse_args()
+
+    with open(options.params, 'r') as paramsfp:
+        words, w2i, pos, rels, stored_opt = pickle.load(paramsfp)
+
+    stored_opt.external_embedding = options.external_embedding
+    stored_opt.predict_batch = options.predict_batch
+
+    parser = ArcHybridLSTM(words, pos, rels, w2i, stored_opt)
+    parser.Load(options.model)
+
+    # Greedy decoding always runs first, as the reference for the speed column.
+    beams = [int(b) for b in options.beams.split(',')]
+    greedy = None
+    print 'Beam\tWords/sec\tSpeed\tUAS\tLAS'
+    for beam in [1] + [b for b in beams if b != 1]:
+        parser.beam = beam
+        ts = time.time()
+        pred = list(parser.Predict(options.conll_test))
+        te = time.time()
+
+        entries = [entry for sentence in pred for entry in sentence[1:] if isinstance(entry, utils.ConllEntry)]
+        heads = sum(1 for entry in entries if entry.pred_parent_id == entry.parent_id)
+        labels = sum(1 for entry in entries if entry.pred_parent_id == entry.parent_id and entry.pred_relation == entry.relation)
+        wps = len(entries) / (te - ts)
+        greedy = greedy or wps
+        print '%d\t%.1f\t%.2fx\t%.2f\t%.2f' % (beam, wps, wps / greedy, 100.0 * heads / len(entries), 100.0 * labels / len(entries))
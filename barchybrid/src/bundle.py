@@ -0,0 +1,102 @@
+from optparse import Values
+import json, struct
+import numpy as np
+
+# A bundle holds everything a trained parser needs in one file:
+#
+#   MAGIC | version (uint32) | header length (uint64) | JSON header | arrays
+#
+# The header stores the options as plain data and the name, dtype, shape and offset of
+# every array. Arrays start on ALIGN byte boundaries: the vocabularies as newline-joined
+# byte strings plus word counts, the external embedding words and the values of all
+# model parameters in creation order. read() memory-maps them, but load() still copies
+# everything once: the vocabularies into the dicts and lists the parsers look words up
+# in, the parameter values into DyNet. Only the pickle and text parsing are saved.
+MAGIC = 'BISTBNDL'
+VERSION = 1
+ALIGN = 64
+
+
+def _strings(strings):
+    return np.array(bytearray('\n'.join(strings)), dtype=np.uint8)
+
+
+def _unstrings(array):
+    return array.tostring().split('\n') if len(array) else []
+
+
+def save(path, parser, words, w2i, pos, rels, options):
+    # words is the training word Counter; words are stored in w2i order with their counts.
+    options = dict(vars(options))
+    iwords = sorted(w2i, key=w2i.get)
+    arrays = [('words', _strings(iwords)), ('counts', np.array([words[w] for w in iwords], dtype=np.int64)),
+              ('pos', _strings(pos)), ('rels', _strings(rels))]
+
+    # The rows of elookup are stored with the parameters, so the embedding file is only
+    # needed again for vocabulary-restricted models (see --extrn-restrict).
+    options.pop('extrn_words', None)
+    if parser.external_embedding is not None:
+        arrays.append(('extrn_words', _strings(parser.external_embedding)))
+        options['extrn_dims'] = parser.edim
+
+    for i, param in enumerate(parser.model.parameters_list()):
+        arrays.append(('param/%d' % i, param.as_array() if 0 not in param.shape() else np.zeros(param.shape())))
+    for i, param in enumerate(parser.model.lookup_parameters_list()):
+        arrays.append(('lookup/%d' % i, param.as_array()))
+
+    entries, offset = [], 0
+    for name, array in arrays:
+        array = np.ascontiguousarray(array)
+        entries.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header = json.dumps({'options': options, 'arrays': entries})
+
+    with open(path, 'wb') as bundleFP:
+        bundleFP.write(MAGIC + struct.pack('<IQ', VERSION, len(header)) + header)
+        start = -(-bundleFP.tell() // ALIGN) * ALIGN
+        for entry, (name, array) in zip(entries, arrays):
+            bundleFP.seek(start + entry['offset'])
+            bundleFP.write(np.ascontiguousarray(array).tostring())
+
+
+def read(path):
+    # Options (as an optparse Values object) and a dict of memory-mapped arrays.
+    with open(path, 'rb') as bundleFP:
+        if bundleFP.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a parser bundle')
+        version, length = struct.unpack('<IQ', bundleFP.read(12))
+        if version > VERSION:
+            raise ValueError('%s has bundle version %d, only %d is supported' % (path, version, VERSION))
+        header = json.loads(bundleFP.read(length))
+        start = -(-bundleFP.tell() // ALIGN) * ALIGN
+
+    options = Values({str(k): str(v) if isinstance(v, unicode) else v for k, v in header['options'].iteritems()})
+    arrays = {}
+    for entry in header['arrays']:
+        shape = tuple(entry['shape'])
+        if 0 in shape:
+            arrays[entry['name']] = np.zeros(shape, dtype=entry['dtype'])
+        else:
+            arrays[entry['name']] = np.memmap(path, dtype=entry['dtype'], mode='r', offset=start + entry['offset'], shape=shape)
+    return options, arrays
+
+
+def load(path, cls, **overrides):
+    # Build a parser of class cls from a bundle; overrides replace stored options.
+    options, arrays = read(path)
+    for name, value in overrides.iteritems():
+        setattr(options, name, value)
+
+    iwords = _unstrings(arrays['words'])
+    words = dict(zip(iwords, arrays['counts'].tolist()))
+    w2i = {w: i for i, w in enumerate(iwords)}
+    if 'extrn_words' in arrays:
+        options.extrn_words = _unstrings(arrays['extrn_words'])
+
+    parser = cls(words, _unstrings(arrays['pos']), _unstrings(arrays['rels']), w2i, options)
+    for i, param in enumerate(parser.model.parameters_list()):
+        if 0 not in param.shape():
+            param.set_value(np.array(arrays['param/%d' % i]))
+    for i, param in enumerate(parser.model.lookup_parameters_list()):
+        param.init_from_array(np.array(arrays['lookup/%d' % i]))
+    return parser
@@ -0,0 +1,101 @@
+from optparse import OptionParser
+import numpy as np
+import random, utils
+
+# Randomized checks of the transition-system helpers in utils:
+#  * isProj against the quadratic ParseForest reduction it replaced, on random head
+#    sequences (cyclic and disconnected ones included);
+#  * ArcHybridOracle costs against the number of reachable gold arcs lost, found by
+#    exhaustive search, in random states of random projective trees.
+
+
+def slowIsProj(heads):
+    # The original check: repeatedly attach a neighbouring root that has collected all
+    # its dependents, rescanning the list of roots after every attachment.
+    roots = range(len(heads))
+    unassigned = [sum(1 for head in heads if head == i) for i in xrange(len(heads))]
+    for _ in xrange(len(heads)):
+        for i in xrange(len(roots) - 1):
+            if heads[roots[i]] == roots[i+1] and unassigned[roots[i]] == 0:
+                unassigned[roots[i+1]] -= 1
+                del roots[i]
+                break
+            if heads[roots[i+1]] == roots[i] and unassigned[roots[i+1]] == 0:
+                unassigned[roots[i]] -= 1
+                del roots[i+1]
+                break
+    return len(roots) == 1
+
+
+def sentence(heads):
+    return [utils.ConllEntry(i, 'w', 'w', 'NN', 'NN', parent_id=head) for i, head in enumerate(heads)]
+
+
+def reachable(stack, b, n, goldHeads, memo):
+    # Most gold arcs that can still be built from a configuration.
+    key = (stack, b)
+    if key not in memo:
+        best = 0
+        if stack and b < n:
+            best = max(best, int(goldHeads[stack[-1]] == b) + reachable(stack[:-1], b, n, goldHeads, memo))
+        if len(stack) > 1 and stack[-1] != n - 1:
+            best = max(best, int(goldHeads[stack[-1]] == stack[-2]) + reachable(stack[:-1], b, n, goldHeads, memo))
+        if b < n - 1:
+            best = max(best, reachable(stack + (b,), b + 1, n, goldHeads, memo))
+        memo[key] = best
+    return memo[key]
+
+
+def exactCosts(state, goldHeads, memo):
+    stack, b, n = tuple(state.stack[:state.size]), state.bufferHead, state.n
+    now = reachable(stack, b, n, goldHeads, memo)
+    costs = [None, None, None]
+    if state.canLeftArc():
+        costs[0] = now - int(goldHeads[stack[-1]] == b) - reachable(stack[:-1], b, n, goldHeads, memo)
+    if state.canRightArc():
+        costs[1] = now - int(goldHeads[stack[-1]] == stack[-2]) - reachable(stack[:-1], b, n, goldHeads, memo)
+    if state.canShift():
+        costs[2] = now - reachable(stack + (b,), b + 1, n, goldHeads, memo)
+    return costs
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--trials", type="int", dest="trials", default=20000)
+    parser.add_option("--oracle-trials", type="int", dest="oracle_trials", default=2000)
+    parser.add_option("--max-words", type="int", dest="max_words", default=12)
+    parser.add_option("--seed", type="int", dest="seed", default=1)
+
+    (options, args) = parser.parse_args()
+    random.seed(options.seed)
+
+    for trial in xrange(options.trials):
+        n = random.randint(1, options.max_words)
+        heads = [-1] + [random.randint(0, n) for _ in xrange(n)]
+        if utils.isProj(sentence(heads)) != slowIsProj(heads):
+            raise AssertionError('isProj differs for heads %s' % heads)
+    print 'isProj agrees with the quadratic check on', options.trials, 'random head sequences.'
+
+    checked = 0
+    while checked < options.oracle_trials:
+        n = random.randint(1, options.max_words)
+        heads = [-1] + [random.randint(0, n) for _ in xrange(n)]
+        if not utils.isProj(sentence(heads)) or any(h == i for i, h in enumerate(heads)):
+            continue
+        checked += 1
+
+        # Positions as in ArcHybridLSTM.Train: the root (id 0) is the last position.
+        heads = np.roll(np.array(heads), -1)
+        goldHeads = np.where(heads >= 0, (heads - 1) % (n + 1), -1)
+        state, oracle, memo = utils.ArcHybridState(n + 1, 0), utils.ArcHybridOracle(goldHeads), {}
+        while not state.isFinal():
+            expected = exactCosts(state, goldHeads, memo)
+            costs = oracle.costs(state)
+            for transition in xrange(3):
+                if expected[transition] is not None and expected[transition] != costs[transition]:
+                    raise AssertionError('cost %d of transition %d should be %d, gold heads %s, stack %s, buffer %d'
+                                         % (costs[transition], transition, expected[transition], goldHeads.tolist(), state.stack[:state.size].tolist(), state.bufferHead))
+            transition = random.choice([t for t in xrange(3) if expected[t] is not None])
+            oracle.apply(state, transition)
+            state.apply(transition, -1)
+    print 'ArcHybridOracle costs are exact in every state of', options.oracle_trials, 'random walks over projective trees.'
@@ -0,0 +1,86 @@
+from dynet import *
+import numpy as np
+import random
+
+
+class BiLSTMEncoder:
+    # Batched embedding lookup and (bi-)BiLSTM encoding shared by both parsers.
+    #
+    # Sentences are given as int arrays of lookup indices, one row per token and one
+    # column per lookup table. They are padded to the longest sentence and run through
+    # the builders as one DyNet batch; the backward builders read every sentence in
+    # reverse, so padding always comes last and never reaches a real token's state.
+    def __init__(self, lookups, builders=None, bbuilders=None, backwardFirst=False):
+        self.lookups = lookups
+        self.builders = builders
+        self.bbuilders = bbuilders
+        # The graph-based parser stacks the backward state above the forward one.
+        self.backwardFirst = backwardFirst
+
+    @staticmethod
+    def dropout(indices, keep):
+        # Replace indices by the unknown index 0 with probability 1 - keep. All columns of a
+        # token share one draw, so a column with a larger keep probability is always kept
+        # when one with a smaller probability is. Draws come from the random module, which
+        # the parsers seed.
+        draw = np.array([[random.random()] for _ in xrange(len(indices))])
+        return np.where(draw < keep, indices, 0)
+
+    def encode(self, indices_list, keep_list=None, lookups=None):
+        # One (dims x n) matrix per sentence: the BiLSTM states, or the concatenated
+        # embeddings when there are no builders. lookups may replace the tables for one
+        # call; a NumPy matrix there is used as a frozen table.
+        lookups = lookups or self.lookups
+        if keep_list is not None:
+            indices_list = [self.dropout(indices, keep) for indices, keep in zip(indices_list, keep_list)]
+
+        lengths = [len(indices) for indices in indices_list]
+        padded = np.ones((len(indices_list), max(lengths), len(lookups)), dtype=np.int64)
+        rpadded = np.ones(padded.shape, dtype=np.int64)
+        for b, indices in enumerate(indices_list):
+            padded[b, :len(indices)] = indices
+            rpadded[b, :len(indices)] = indices[::-1]
+
+        if self.builders is None:
+            return self.__unbatch(concatenate_cols(self.__embed(lookups, padded)), lengths)
+
+        layer = self.__bilstm(self.builders, self.__embed(lookups, padded), self.__embed(lookups, rpadded), lengths)
+        if self.bbuilders is not None:
+            layer = self.__bilstm(self.bbuilders, self.__columns(layer, lengths, False), self.__columns(layer, lengths, True), lengths)
+
+        return layer
+
+    def __embed(self, lookups, padded):
+        # One batched input vector per time step.
+        return [concatenate([inputTensor(lookup[padded[:, t, k]].T, batched=True) if isinstance(lookup, np.ndarray) else lookup_batch(lookup, padded[:, t, k].tolist())
+                             for k, lookup in enumerate(lookups)])
+                for t in xrange(padded.shape[1])]
+
+    def __run(self, builder, inputs):
+        state = builder.initial_state()
+        outputs = []
+        for x in inputs:
+            state = state.add_input(x)
+            outputs.append(state.output())
+        return concatenate_cols(outputs)
+
+    def __bilstm(self, builders, forward, backward, lengths):
+        forward = self.__unbatch(self.__run(builders[0], forward), lengths)
+        backward = [select_cols(matrix, range(n - 1, -1, -1)) for matrix, n in zip(self.__unbatch(self.__run(builders[1], backward), lengths), lengths)]
+        if self.backwardFirst:
+            return [concatenate([b, f]) for f, b in zip(forward, backward)]
+        return [concatenate([f, b]) for f, b in zip(forward, backward)]
+
+    def __unbatch(self, batched, lengths):
+        return [select_cols(pick_batch_elem(batched, b), range(n)) for b, n in enumerate(lengths)]
+
+    def __columns(self, matrices, lengths, reverse):
+        # Batched per-step inputs of the next layer from per-sentence matrices.
+        rows, maxlen = matrices[0].dim()[0][0], max(lengths)
+        padded = []
+        for matrix, n in zip(matrices, lengths):
+            if reverse:
+                matrix = select_cols(matrix, range(n - 1, -1, -1))
+            padded.append(concatenate_cols([matrix, zeros((rows, maxlen - n))]) if n < maxlen else matrix)
+        batched = concatenate_to_batch(padded)
+        return [pick(batched, t, 1) for t in xrange(maxlen)]
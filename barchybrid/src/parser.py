@@ -1,6 +1,22 @@
 from optparse import OptionParser
 from arc_hybrid import ArcHybridLSTM
-import pickle, utils, os, time, sys
+import pickle, utils, bundle, multiprocessing, os, time, sys
+
+
+def predictChunk(sentences):
+    # Runs in a worker forked after the model was loaded, on its copy-on-write parser.
+    return list(parser.PredictSentences(sentences))
+
+
+def predict(parser, sentences, pool, options):
+    # Parsed sentences in input order. With a pool of workers the input is cut into chunks
+    # of about --chunk-tokens tokens, so that long and short sentences spread evenly, and
+    # only a few chunks per worker are in flight at a time.
+    if pool is None:
+        return parser.PredictSentences(sentences)
+    chunks = utils.ordered_map(pool, predictChunk, utils.prefetch(utils.token_chunks(sentences, options.chunk_tokens), options.prefetch, parser.timer), 2 * options.workers)
+    return (sentence for chunk in chunks for sentence in chunk)
+
 
 if __name__ == '__main__':
     parser = OptionParser()
@@ -9,6 +25,8 @@ if __name__ == '__main__':
     parser.add_option("--test", dest="conll_test", help="Annotated CONLL test file", metavar="FILE", default="../data/PTB_SD_3_3_0/test.conll")
     parser.add_option("--params", dest="params", help="Parameters file", metavar="FILE", default="params.pickle")
     parser.add_option("--extrn", dest="external_embedding", help="External embeddings", metavar="FILE")
+    parser.add_option("--bundle", dest="bundle", help="Load a single-file model bundle instead of --model and --params", metavar="FILE")
+    parser.add_option("--save-bundle", action="store_true", dest="saveBundle", default=False)
     parser.add_option("--model", dest="model", help="Load/Save model file", metavar="FILE", default="barchybrid.model")
     parser.add_option("--wembedding", type="int", dest="wembedding_dims", default=100)
     parser.add_option("--pembedding", type="int", dest="pembedding_dims", default=25)
@@ -22,6 +40,11 @@ if __name__ == '__main__':
     parser.add_option("--activation", type="string", dest="activation", default="tanh")
     parser.add_option("--lstmlayers", type="int", dest="lstm_layers", default=2)
     parser.add_option("--lstmdims", type="int", dest="lstm_dims", default=200)
+    parser.add_option("--predict-batch", type="int", dest="predict_batch", default=32)
+    parser.add_option("--workers", type="int", dest="workers", help="Processes parsing the test file in parallel", default=1)
+    parser.add_option("--chunk-tokens", type="int", dest="chunk_tokens", help="Tokens per work unit of a parallel parse", default=2000)
+    parser.add_option("--prefetch", type="int", dest="prefetch", help="Batches read and indexed in the background, 0 to disable", default=4)
+    parser.add_option("--beam", type="int", dest="beam", default=1)
     parser.add_option("--dynet-seed", type="int", dest="seed", default=7)
     parser.add_option("--disableoracle", action="store_false", dest="oracle", default=True)
     parser.add_option("--disableblstm", action="store_false", dest="blstmFlag", default=True)
@@ -30,18 +53,43 @@ if __name__ == '__main__':
     parser.add_option("--userlmost", action="store_true", dest="rlFlag", default=False)
     parser.add_option("--userl", action="store_true", dest="rlMostFlag", default=False)
     parser.add_option("--predict", action="store_true", dest="predictFlag", default=False)
+    parser.add_option("--preprocess", action="store_true", dest="preprocessFlag", default=False)
+    parser.add_option("--extrn-restrict", action="store_true", dest="extrnRestrict", default=False)
     parser.add_option("--dynet-mem", type="int", dest="cnn_mem", default=512)
 
     (options, args) = parser.parse_args()
+    if options.predictFlag:
+        inputs = utils.conll_inputs([options.conll_test] + args)
+        if '-' in inputs:
+            # Parsed sentences go to stdout, everything else to stderr.
+            sys.stdout = sys.stderr
     print 'Using external embedding:', options.external_embedding
 
     if not options.predictFlag:
-        if not (options.rlFlag or options.rlMostFlag or options.headFlag):
+        if not (options.rlFlag or options.rlMostFlag or options.headFlag or options.preprocessFlag):
             print 'You must use either --userlmost or --userl or --usehead (you can use multiple)'
             sys.exit()
 
-        print 'Preparing vocab'
-        words, w2i, pos, rels = utils.vocab(options.conll_train)
+        if os.path.isdir(options.conll_train):
+            print 'Loading preprocessed corpus'
+            corpus = utils.Corpus.load(options.conll_train)
+            words, w2i, pos, rels = corpus.vocab
+        else:
+            print 'Preparing vocab'
+            words, w2i, pos, rels = utils.vocab(options.conll_train)
+            corpus = utils.index_corpus(options.conll_train, words, w2i, pos, rels)
+
+        if options.preprocessFlag:
+            corpuspath = os.path.join(options.output, os.path.basename(options.conll_train) + '.corpus')
+            corpus.save(corpuspath)
+            print 'Saved preprocessed corpus to', corpuspath
+            sys.exit()
+
+        if options.extrnRestrict and options.external_embedding is not None:
+            # Only words of the training data get external embedding rows in the model.
+            index = utils.EmbeddingIndex(options.external_embedding)
+            options.extrn_words = [word for word in sorted(set(str(form) for form in corpus.forms) | set(words)) if index.row(word) >= 0]
+            print 'Restricted external embedding to', len(options.extrn_words), 'words'
 
         with open(os.path.join(options.output, options.params), 'w') as paramsfp:
             pickle.dump((words, w2i, pos, rels, options), paramsfp)
@@ -52,7 +100,7 @@ if __name__ == '__main__':
 
         for epoch in xrange(options.epochs):
             print 'Starting epoch', epoch
-            parser.Train(options.conll_train)
+            parser.Train(corpus)
             conllu = (os.path.splitext(options.conll_dev.lower())[1] == '.conllu')
             devpath = os.path.join(options.output, 'dev_epoch_' + str(epoch+1) + ('.conll' if not conllu else '.conllu'))
             utils.write_conll(devpath, parser.Predict(options.conll_dev))
@@ -64,25 +112,62 @@ if __name__ == '__main__':
             
             print 'Finished predicting dev'
             parser.Save(os.path.join(options.output, options.model + str(epoch+1)))
+            if options.saveBundle:
+                bundle.save(os.path.join(options.output, options.model + str(epoch+1) + '.bundle'), parser, words, w2i, pos, rels, options)
     else:
-        with open(options.params, 'r') as paramsfp:
-            words, w2i, pos, rels, stored_opt = pickle.load(paramsfp)
+        overrides = {'predict_batch': options.predict_batch, 'prefetch': options.prefetch, 'beam': options.beam}
+        if options.bundle is not None:
+            if options.external_embedding is not None:
+                overrides['external_embedding'] = options.external_embedding
 
-        stored_opt.external_embedding = options.external_embedding
+            parser = bundle.load(options.bundle, ArcHybridLSTM, **overrides)
+        else:
+            with open(options.params, 'r') as paramsfp:
+                words, w2i, pos, rels, stored_opt = pickle.load(paramsfp)
+
+            stored_opt.external_embedding = options.external_embedding
+            for name, value in overrides.iteritems():
+                setattr(stored_opt, name, value)
+
+            parser = ArcHybridLSTM(words, pos, rels, w2i, stored_opt)
+            parser.Load(options.model)
+        # A single plain file is parsed to test_pred.conll[u] in --outdir and evaluated;
+        # stdin, several files and gzip compressed files are streamed to stdout and mirrored
+        # paths under --outdir instead.
+        evaluate = len(inputs) == 1 and inputs[0] != '-' and not inputs[0].endswith('.gz')
+        if evaluate:
+            options.conll_test = inputs[0]
+            conllu = (os.path.splitext(options.conll_test.lower())[1] == '.conllu')
+            tespath = os.path.join(options.output, 'test_pred.conll' if not conllu else 'test_pred.conllu')
+            outputs = [tespath]
+        else:
+            outputs = utils.mirror_paths(inputs, options.output)
+            if any(os.path.abspath(inpath) == os.path.abspath(outpath) for inpath, outpath in zip(inputs, outputs) if inpath != '-'):
+                sys.exit('Outputs would overwrite inputs, choose another --outdir')
 
-        parser = ArcHybridLSTM(words, pos, rels, w2i, stored_opt)
-        parser.Load(options.model)
-        conllu = (os.path.splitext(options.conll_test.lower())[1] == '.conllu')
-        tespath = os.path.join(options.output, 'test_pred.conll' if not conllu else 'test_pred.conllu')
+        # Workers are forked only after the model and the external embeddings are loaded.
+        parser.InitExternal()
+        pool = multiprocessing.Pool(options.workers) if options.workers > 1 else None
+
+        parser.timer.reset()
         ts = time.time()
-        pred = list(parser.Predict(options.conll_test))
+        for inpath, outpath in zip(inputs, outputs):
+            writer = utils.ConllWriter(outpath, timer=parser.timer)
+            with utils.open_conll(inpath) as conllFP:
+                for sentence in predict(parser, utils.read_conll(conllFP, False), pool, options):
+                    writer.write(sentence)
+            writer.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
         te = time.time()
-        utils.write_conll(tespath, pred)
+        print 'Stage times:', parser.timer
 
-        if not conllu:
-            os.system('perl src/utils/eval.pl -g ' + options.conll_test + ' -s ' + tespath  + ' > ' + tespath + '.txt')
-        else:
-            os.system('python src/utils/evaluation_script/conll17_ud_eval.py -v -w src/utils/evaluation_script/weights.clas ' + options.conll_test + ' ' + tespath + ' > ' + testpath + '.txt')
+        if evaluate:
+            if not conllu:
+                os.system('perl src/utils/eval.pl -g ' + options.conll_test + ' -s ' + tespath  + ' > ' + tespath + '.txt')
+            else:
+                os.system('python src/utils/evaluation_script/conll17_ud_eval.py -v -w src/utils/evaluation_script/weights.clas ' + options.conll_test + ' ' + tespath + ' > ' + testpath + '.txt')
         
         print 'Finished predicting test',te-ts
 
@@ -1,72 +1,275 @@
-from collections import Counter
-import re
+from collections import Counter, deque
+from itertools import chain
+import Queue, copy, glob, gzip, hashlib, os, pickle, re, sys, threading, time
+import numpy as np
 
 
+class ConllEntry(object):
+    # A token is a slotted record of interned strings; the normalized form is computed on
+    # first use. Parsers keep their per-sentence vectors and transition state elsewhere.
+    __slots__ = ['id', 'form', 'lemma', 'cpos', 'pos', 'feats', 'parent_id', 'relation', 'deps', 'misc', 'pred_parent_id', 'pred_relation', '_norm']
 
-class ConllEntry:
     def __init__(self, id, form, lemma, pos, cpos, feats=None, parent_id=None, relation=None, deps=None, misc=None):
         self.id = id
-        self.form = form
-        self.norm = normalize(form)
-        self.cpos = cpos.upper()
-        self.pos = pos.upper()
+        self.form = _intern(form)
+        self._norm = None
+        self.cpos = _intern(cpos.upper())
+        self.pos = _intern(pos.upper())
         self.parent_id = parent_id
-        self.relation = relation
+        self.relation = _intern(relation)
 
-        self.lemma = lemma
-        self.feats = feats
-        self.deps = deps
-        self.misc = misc
+        self.lemma = _intern(lemma)
+        self.feats = _intern(feats)
+        self.deps = _intern(deps)
+        self.misc = _intern(misc)
 
         self.pred_parent_id = None
         self.pred_relation = None
 
+    @property
+    def norm(self):
+        if self._norm is None:
+            self._norm = _intern(normalize(self.form))
+        return self._norm
+
     def __str__(self):
         values = [str(self.id), self.form, self.lemma, self.cpos, self.pos, self.feats, str(self.pred_parent_id) if self.pred_parent_id is not None else None, self.pred_relation, self.deps, self.misc]
         return '\t'.join(['_' if v is None else v for v in values])
 
 
-class ParseForest:
-    def __init__(self, sentence):
-        self.roots = list(sentence)
+def _intern(s):
+    return intern(s) if type(s) is str else s
 
-        for root in self.roots:
-            root.children = []
-            root.scores = None
-            root.parent = None
-            root.pred_parent_id = 0 # None
-            root.pred_relation = 'rroot' # None
-            root.vecs = None
-            root.lstms = None
 
-    def __len__(self):
-        return len(self.roots)
+class ArcHybridState:
+    '''
+    Arc-hybrid transition state over the positions 0..n-1 of a sentence whose root is the
+    last position. The buffer is always the suffix starting at bufferHead, so the stack is
+    the only list kept; predicted heads (positions) and relation indices live in arrays.
+    '''
+    def __init__(self, n, nnvecs):
+        self.n = n
+        self.stack = np.zeros(n, dtype=np.int32)
+        self.size = 0
+        self.bufferHead = 0
+        self.heads = -np.ones(n, dtype=np.int32)
+        self.rels = -np.ones(n, dtype=np.int32)
+        # Position of the token vector used for each of the nnvecs feature vectors.
+        self.vecs = np.repeat(np.arange(n, dtype=np.int32)[:, None], nnvecs, axis=1)
+
+    def copy(self):
+        state = copy.copy(self)
+        state.stack = self.stack.copy()
+        state.heads = self.heads.copy()
+        state.rels = self.rels.copy()
+        state.vecs = self.vecs.copy()
+        return state
+
+    def isFinal(self):
+        return self.bufferHead == self.n - 1 and self.size == 0
+
+    def canLeftArc(self):
+        return self.size > 0 and self.bufferHead < self.n
+
+    def canRightArc(self):
+        return self.size > 1 and self.stack[self.size - 1] != self.n - 1
 
+    def canShift(self):
+        return self.bufferHead < self.n - 1
 
-    def Attach(self, parent_index, child_index):
-        parent = self.roots[parent_index]
-        child = self.roots[child_index]
+    def apply(self, transition, rel):
+        '''
+        Apply left-arc (0), right-arc (1) or shift (2); arcs return (child, parent) positions.
+        '''
+        if transition == 2:
+            self.stack[self.size] = self.bufferHead
+            self.size += 1
+            self.bufferHead += 1
+            return None
 
-        child.pred_parent_id = parent.id
-        del self.roots[child_index]
+        self.size -= 1
+        child = self.stack[self.size]
+        parent = self.bufferHead if transition == 0 else self.stack[self.size - 1]
+        self.heads[child] = parent
+        self.rels[child] = rel
+        return child, parent
+
+
+class ArcHybridOracle:
+    '''
+    Dynamic-oracle costs of the arc-hybrid transitions for an ArcHybridState.
+    Gold heads are positions (-1 for none). The number of gold dependents of every token
+    still in the buffer and on the stack is kept up to date as transitions are applied,
+    so each cost is an O(1) lookup.
+    '''
+    def __init__(self, goldHeads):
+        n = len(goldHeads)
+        self.goldHeads = goldHeads
+        self.onStack = np.zeros(n, dtype=bool)
+        self.bufferDeps = np.bincount(goldHeads[goldHeads >= 0], minlength=n)
+        self.stackDeps = np.zeros(n, dtype=np.int32)
+
+    def costs(self, state):
+        '''
+        Costs of left-arc, right-arc and shift; invalid transitions cost 1.
+        '''
+        size, b = state.size, state.bufferHead
+        s0 = state.stack[size-1] if size > 0 else -1
+        s1 = state.stack[size-2] if size > 1 else -1
+        h0 = self.goldHeads[s0]
+        hb = self.goldHeads[b] if b < state.n else -1
+
+        left_cost = int((s1 >= 0 and h0 == s1) or h0 > b) + self.bufferDeps[s0] if state.canLeftArc() else 1
+        right_cost = int(h0 >= b) + self.bufferDeps[s0] if state.canRightArc() else 1
+        shift_cost = int(hb >= 0 and hb != s0 and self.onStack[hb]) + self.stackDeps[b] if state.canShift() else 1
+        return left_cost, right_cost, shift_cost
+
+    def apply(self, state, transition):
+        '''
+        Update the counters for a transition about to be applied to state.
+        '''
+        if transition == 2:
+            b = state.bufferHead
+            self.onStack[b] = True
+            if self.goldHeads[b] >= 0:
+                self.bufferDeps[self.goldHeads[b]] -= 1
+                self.stackDeps[self.goldHeads[b]] += 1
+        else:
+            s0 = state.stack[state.size-1]
+            self.onStack[s0] = False
+            if self.goldHeads[s0] >= 0:
+                self.stackDeps[self.goldHeads[s0]] -= 1
 
 
 def isProj(sentence):
-    forest = ParseForest(sentence)
-    unassigned = {entry.id: sum([1 for pentry in sentence if pentry.parent_id == entry.id]) for entry in sentence}
-
-    for _ in xrange(len(sentence)):
-        for i in xrange(len(forest.roots) - 1):
-            if forest.roots[i].parent_id == forest.roots[i+1].id and unassigned[forest.roots[i].id] == 0:
-                unassigned[forest.roots[i+1].id]-=1
-                forest.Attach(i+1, i)
-                break
-            if forest.roots[i+1].parent_id == forest.roots[i].id and unassigned[forest.roots[i+1].id] == 0:
-                unassigned[forest.roots[i].id]-=1
-                forest.Attach(i, i+1)
+    # Reduce the gold tree with an arc-standard stack: a token is attached to its stack
+    # neighbour once it has collected all its dependents. The tree is projective iff only
+    # the root is left; every token is pushed and popped once.
+    heads = [entry.parent_id for entry in sentence]
+    unassigned = [0] * len(heads)
+    for head in heads:
+        if 0 <= head < len(heads):
+            unassigned[head] += 1
+
+    stack = []
+    for i in xrange(len(heads)):
+        stack.append(i)
+        while len(stack) > 1:
+            s1, s0 = stack[-2], stack[-1]
+            if heads[s1] == s0 and unassigned[s1] == 0:
+                unassigned[s0] -= 1
+                del stack[-2]
+            elif heads[s0] == s1 and unassigned[s0] == 0:
+                unassigned[s1] -= 1
+                stack.pop()
+            else:
                 break
 
-    return len(forest.roots) == 1
+    return len(stack) == 1
+
+
+_projMasks = {}
+def projectiveMask(conll_path):
+    # Projectivity of every sentence of a corpus. It is cached in memory for later epochs
+    # and in a .proj.npz file next to the corpus, keyed by the md5 of its contents.
+    stat = os.stat(conll_path)
+    key = (os.path.abspath(conll_path), stat.st_size, stat.st_mtime)
+    if key in _projMasks:
+        return _projMasks[key]
+
+    md5 = hashlib.md5()
+    with open(conll_path, 'rb') as conllFP:
+        for chunk in iter(lambda: conllFP.read(1 << 20), ''):
+            md5.update(chunk)
+    digest = md5.hexdigest()
+
+    cache_path = conll_path + '.proj.npz'
+    mask = None
+    if os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if str(cached['md5']) == digest:
+            mask = cached['mask']
+
+    if mask is None:
+        with open(conll_path, 'r') as conllFP:
+            mask = np.array([isProj([entry for entry in sentence if isinstance(entry, ConllEntry)]) for sentence in read_conll(conllFP, False)], dtype=bool)
+        try:
+            with open(cache_path, 'wb') as cacheFP:
+                np.savez(cacheFP, md5=np.array(digest), mask=mask)
+        except IOError:
+            print 'Could not write the projectivity cache', cache_path
+
+    _projMasks[key] = mask
+    return mask
+
+
+class Corpus:
+    '''
+    A training corpus as flat token arrays (roots included): word, POS and form indices,
+    gold head and relation index and the word-dropout keep probability of every token,
+    with offsets delimiting the sentences and forms holding the distinct word forms.
+    save writes one .npy file per array plus the vocabulary to a directory; load
+    memory-maps the arrays, so no per-token Python objects are built.
+    '''
+    arrays = ['word', 'pos', 'form', 'head', 'rel', 'keep', 'offsets', 'forms']
+
+    def __init__(self, vocab, **arrays):
+        # vocab is the (words, w2i, pos, rels) tuple returned by vocab().
+        self.vocab = vocab
+        for name in Corpus.arrays:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def span(self, i):
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in Corpus.arrays:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'vocab.pickle'), 'wb') as vocabFP:
+            pickle.dump(self.vocab, vocabFP)
+
+    @staticmethod
+    def load(path):
+        with open(os.path.join(path, 'vocab.pickle'), 'rb') as vocabFP:
+            vocab = pickle.load(vocabFP)
+        return Corpus(vocab, **{name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in Corpus.arrays})
+
+
+def index_corpus(conll_path, words, w2i, pos, rels):
+    # Word and POS ids are shifted by 3 like the parsers' lookup tables (unknown, padding
+    # and initial rows come first).
+    wids = {w: i + 3 for w, i in w2i.iteritems()}
+    pids = {p: i + 3 for i, p in enumerate(pos)}
+    rids = {r: i for i, r in enumerate(rels)}
+    forms = {}
+    columns = {name: [] for name in ['word', 'pos', 'form', 'head', 'rel', 'keep']}
+    offsets = [0]
+
+    with open(conll_path, 'r') as conllFP:
+        for sentence in read_conll(conllFP, True, projectiveMask(conll_path)):
+            for entry in sentence:
+                if isinstance(entry, ConllEntry):
+                    c = float(words.get(entry.norm, 0))
+                    columns['word'].append(wids.get(entry.norm, 0))
+                    columns['pos'].append(pids.get(entry.pos, 0))
+                    columns['form'].append(forms.setdefault(entry.form, len(forms)))
+                    columns['head'].append(entry.parent_id)
+                    columns['rel'].append(rids.get(entry.relation, 0))
+                    columns['keep'].append(c / (0.25 + c))
+            offsets.append(len(columns['word']))
+
+    arrays = {name: np.array(values, dtype=np.float32 if name == 'keep' else np.int32) for name, values in columns.iteritems()}
+    arrays['offsets'] = np.array(offsets, dtype=np.int64)
+    arrays['forms'] = np.array(sorted(forms, key=forms.get))
+    return Corpus((words, w2i, pos, rels), **arrays)
 
 
 def vocab(conll_path):
@@ -75,7 +278,7 @@ def vocab(conll_path):
     relCount = Counter()
 
     with open(conll_path, 'r') as conllFP:
-        for sentence in read_conll(conllFP, True):
+        for sentence in read_conll(conllFP, True, projectiveMask(conll_path)):
             wordsCount.update([node.norm for node in sentence if isinstance(node, ConllEntry)])
             posCount.update([node.pos for node in sentence if isinstance(node, ConllEntry)])
             relCount.update([node.relation for node in sentence if isinstance(node, ConllEntry)])
@@ -83,40 +286,350 @@ def vocab(conll_path):
     return (wordsCount, {w: i for i, w in enumerate(wordsCount.keys())}, posCount.keys(), relCount.keys())
 
 
-def read_conll(fh, proj):
+def read_conll(fh, proj, projMask=None):
+    # With proj, non-projective sentences are dropped; projMask (see projectiveMask) gives
+    # the projectivity of every sentence of fh so that it need not be recomputed.
     dropped = 0
     read = 0
-    root = ConllEntry(0, '*root*', '*root*', 'ROOT-POS', 'ROOT-CPOS', '_', -1, 'rroot', '_', '_')
-    tokens = [root]
-    for line in fh:
+    # Every sentence gets its own root entry, as sentences may be parsed together.
+    root = lambda: ConllEntry(0, '*root*', '*root*', 'ROOT-POS', 'ROOT-CPOS', '_', -1, 'rroot', '_', '_')
+    tokens = [root()]
+    for line in chain(fh, ['']):
         tok = line.strip().split('\t')
         if not tok or line.strip() == '':
             if len(tokens)>1:
-                if not proj or isProj([t for t in tokens if isinstance(t, ConllEntry)]):
+                if not proj or (projMask[read] if projMask is not None else isProj([t for t in tokens if isinstance(t, ConllEntry)])):
                     yield tokens
                 else:
                     #print 'Non-projective sentence dropped'
                     dropped += 1
                 read += 1
-            tokens = [root]
+            tokens = [root()]
         else:
             if line[0] == '#' or '-' in tok[0] or '.' in tok[0]:
                 tokens.append(line.strip())
             else:
                 tokens.append(ConllEntry(int(tok[0]), tok[1], tok[2], tok[4], tok[3], tok[5], int(tok[6]) if tok[6] != '_' else -1, tok[7], tok[8], tok[9]))
-    if len(tokens) > 1:
-        yield tokens
 
     print dropped, 'dropped non-projective sentences.'
     print read, 'sentences read.'
 
 
-def write_conll(fn, conll_gen):
-    with open(fn, 'w') as fh:
-        for sentence in conll_gen:
-            for entry in sentence[1:]:
-                fh.write(str(entry) + '\n')
-            fh.write('\n')
+def load_embeddings(path):
+    # Words and float32 vectors of a text embedding file (header line skipped). A word
+    # listed twice keeps its last vector, and words come in the order the parsers have
+    # always assigned lookup rows in (iteration order of a dict built from the file), so
+    # saved models stay valid. The result is cached in path.npy and path.vocab, which
+    # later runs memory-map instead of parsing the text.
+    cache_path, vocab_path = path + '.npy', path + '.vocab'
+    if os.path.exists(cache_path) and os.path.exists(vocab_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        with open(vocab_path, 'r') as vocabFP:
+            words = vocabFP.read().split('\n')
+        return words, np.load(cache_path, mmap_mode='r')
+
+    with open(path, 'r') as embeddingFP:
+        embeddingFP.readline()
+        rows = {}
+        for line in embeddingFP:
+            word = line.split(' ')[0]
+            if word not in rows:
+                rows[word] = len(rows)
+                dims = len(line.strip().split(' ')) - 1
+
+    if not rows:
+        raise ValueError('no vectors in ' + path)
+    vectors = np.zeros((len(rows), dims), dtype=np.float32)
+    with open(path, 'r') as embeddingFP:
+        embeddingFP.readline()
+        for line in embeddingFP:
+            vectors[rows[line.split(' ')[0]]] = np.array(line.strip().split(' ')[1:], dtype=np.float32)
+
+    words = list(rows)
+    vectors = vectors[[rows[word] for word in words]]
+
+    try:
+        np.save(cache_path, vectors)
+        with open(vocab_path, 'w') as vocabFP:
+            vocabFP.write('\n'.join(words))
+    except IOError:
+        print 'Could not write the embedding cache', cache_path
+
+    return words, vectors
+
+
+def wordHash(word):
+    return np.uint64(int(hashlib.md5(word).hexdigest()[:16], 16))
+
+
+class EmbeddingIndex:
+    '''
+    On-disk index of an embedding file: the sorted 64-bit md5 hashes of its words and the
+    matching rows of the cached vector matrix (see load_embeddings), saved in path.index.npy.
+    Hashes, rows and vectors are memory-mapped, so looking a word up reads a few pages
+    instead of loading the whole vocabulary.
+    '''
+    def __init__(self, path):
+        index_path = path + '.index.npy'
+        if not os.path.exists(index_path) or not os.path.exists(path + '.npy') or os.path.getmtime(index_path) < os.path.getmtime(path):
+            words, vectors = load_embeddings(path)
+            hashes = np.array([wordHash(word) for word in words], dtype=np.uint64)
+            order = np.argsort(hashes)
+            np.save(index_path, np.array([hashes[order], order.astype(np.uint64)]))
+
+        index = np.load(index_path, mmap_mode='r')
+        self.hashes, self.rows = index[0], index[1]
+        self.vectors = np.load(path + '.npy', mmap_mode='r')
+
+    def row(self, word):
+        # Row of word in vectors, or -1.
+        h = wordHash(word)
+        i = np.searchsorted(self.hashes, h)
+        return int(self.rows[i]) if i < len(self.hashes) and self.hashes[i] == h else -1
+
+
+class ExternalRows:
+    '''
+    External embedding rows at prediction time for a model whose elookup only covers its
+    training words. Trained rows come first; any other word found in the embedding index
+    gets a frozen row appended the first time it is seen, and the rest map to row 0.
+    '''
+    def __init__(self, extrnd, trained, index):
+        self.extrnd = dict(extrnd)
+        self.index = index
+        self.missing = set()
+        self.matrix = np.array(trained, dtype=np.float32)
+        self.size = len(self.matrix)
+
+    def get(self, form, norm):
+        # Same preference as extrnd.get(form, extrnd.get(norm, 0)) over the whole file.
+        for word in (form, norm):
+            if word in self.extrnd:
+                return self.extrnd[word]
+            if word not in self.missing:
+                row = self.index.row(word)
+                if row >= 0:
+                    if self.size == len(self.matrix):
+                        self.matrix = np.concatenate([self.matrix, np.zeros_like(self.matrix)])
+                    self.matrix[self.size] = self.index.vectors[row]
+                    self.extrnd[word] = self.size
+                    self.size += 1
+                    return self.extrnd[word]
+                self.missing.add(word)
+        return 0
+
+
+def token_chunks(sentences, tokens):
+    # Group sentences into consecutive chunks of at least tokens lines each (the last one
+    # may be smaller), so that chunks cost about the same to parse.
+    chunk, size = [], 0
+    for sentence in sentences:
+        chunk.append(sentence)
+        size += len(sentence)
+        if size >= tokens:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+def ordered_map(pool, func, items, ahead):
+    # Like pool.imap, but with at most ahead items in flight, so that a long input is
+    # neither read nor buffered all at once. Results come back in input order.
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def conll_inputs(patterns):
+    # Input files for a list of paths and glob patterns, in the given order; '-' is stdin.
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if pattern != '-' else []
+        paths.extend(matches or [pattern])
+    return paths
+
+
+def mirror_paths(paths, outdir):
+    # Output path of every input file: its path relative to the inputs' deepest common
+    # directory, under outdir. stdin maps to stdout ('-').
+    files = [os.path.abspath(path) for path in paths if path != '-']
+    common = os.path.dirname(os.path.commonprefix(files)) if files else ''
+    return [os.path.join(outdir, os.path.relpath(os.path.abspath(path), common)) if path != '-' else '-' for path in paths]
+
+
+def open_conll(path):
+    # '-' is stdin; gzip compressed files are read through gzip.
+    if path == '-':
+        return sys.stdin
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'r')
+
+
+class StageTimer:
+    '''
+    Seconds spent per pipeline stage: reading and indexing the input, building and running
+    graphs, waiting for input and writing the output. Stages on different threads overlap,
+    so the times can add up to more than the elapsed time; a large wait means that the
+    parser is starved by its input.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = Counter()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] += seconds
+
+    def reset(self):
+        with self.lock:
+            self.seconds = Counter()
+
+    def __str__(self):
+        with self.lock:
+            return ', '.join('%s %.2fs' % (stage, seconds) for stage, seconds in sorted(self.seconds.iteritems()))
+
+
+def prefetch(items, size, timer=None, stage='read'):
+    # Iterate items on a background thread that keeps up to size of them ready, so that
+    # reading and indexing overlap the graph computations of the caller. Exceptions of the
+    # producer are raised in the caller. With size 0 items are produced in the caller.
+    # The producing time is recorded as stage in timer, the time blocked on it as 'wait'.
+    # The thread stops when the caller stops iterating, e.g. on an exception or close().
+    timer = timer or StageTimer()
+    items = iter(items)
+    if size <= 0:
+        while True:
+            ts = time.time()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                timer.add(stage, time.time() - ts)
+            yield item
+
+    queue = Queue.Queue(size)
+    stop = threading.Event()
+    end = object()
+
+    def put(entry):
+        # False once the caller has stopped iterating.
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            while True:
+                ts = time.time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    timer.add(stage, time.time() - ts)
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception:
+            put((end, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ts = time.time()
+            item, error = queue.get()
+            timer.add('wait', time.time() - ts)
+            if item is end:
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+class ConllWriter(threading.Thread):
+    '''
+    Writes parsed sentences to path ('-' for stdout, gzip compressed for .gz) on a
+    background thread, so that formatting and output I/O overlap parsing. At most maxsize
+    sentences wait to be written. The output is flushed whenever the thread catches up, so
+    a downstream reader of a pipe sees sentences as soon as they are parsed. The time spent
+    is recorded as 'write' in timer.
+    '''
+    def __init__(self, path, maxsize=256, timer=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.timer = timer or StageTimer()
+        self.queue = Queue.Queue(maxsize)
+        self.error = None
+        self.start()
+
+    def write(self, sentence):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(sentence)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        # After an error the queue is still drained, so that the producer never blocks;
+        # the error is raised in the producer by its next write or close.
+        fh = None
+        try:
+            fh = self.__open()
+        except (IOError, OSError) as e:
+            self.error = e
+
+        while True:
+            sentence = self.queue.get()
+            if sentence is None:
+                break
+            if self.error is None:
+                ts = time.time()
+                try:
+                    fh.write(''.join(str(entry) + '\n' for entry in sentence[1:]) + '\n')
+                    if self.queue.empty():
+                        fh.flush()
+                except (IOError, OSError) as e:
+                    self.error = e
+                self.timer.add('write', time.time() - ts)
+
+        try:
+            if fh is sys.__stdout__:
+                fh.flush()
+            elif fh is not None:
+                fh.close()
+        except (IOError, OSError) as e:
+            self.error = self.error or e
+
+    def __open(self):
+        if self.path == '-':
+            return sys.__stdout__
+        if os.path.dirname(self.path) and not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        return gzip.open(self.path, 'wb') if self.path.endswith('.gz') else open(self.path, 'w')
+
+
+def write_conll(fn, conll_gen, timer=None):
+    writer = ConllWriter(fn, timer=timer)
+    for sentence in conll_gen:
+        writer.write(sentence)
+    writer.close()
 
 
 numberRegex = re.compile("[0-9]+|[0-9]+\\.[0-9]+|[0-9]+[0-9,]+");
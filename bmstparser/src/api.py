@@ -0,0 +1,40 @@
+import bundle
+import numpy as np
+from mstlstm import MSTParserLSTM
+
+
+class Parser:
+    '''
+    In-memory parsing with a model bundle. parse takes sentences as lists of (form, pos)
+    tuples or as arrays from indices, and returns the heads (0 is the root) and relation
+    labels of their words as arrays. Nothing is read or written besides the bundle.
+    '''
+    def __init__(self, parser):
+        self.parser = parser
+        self.labels = np.array(list(parser.irels) + ['_'])
+
+    def indices(self, sentence):
+        # Lookup indices of a list of (form, pos) tuples, reusable across parse calls.
+        return self.parser.Indices([form for form, pos in sentence], [pos for form, pos in sentence])
+
+    def parse(self, sentences, batch_size=None):
+        # One (heads, labels) pair of arrays per sentence, in input order. Sentences are
+        # parsed in batches of similar length.
+        batch_size = batch_size or self.parser.predictBatch
+        indices_list = [sentence if isinstance(sentence, np.ndarray) else self.indices(sentence) for sentence in sentences]
+        order = sorted((i for i, indices in enumerate(indices_list) if len(indices) > 1), key=lambda i: len(indices_list[i]))
+
+        results = [(np.zeros(0, dtype=np.int64), self.labels[:0])] * len(indices_list)
+        for start in xrange(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            heads_list, rels_list = self.parser.Parse([indices_list[i] for i in batch])
+            for i, heads, rels in zip(batch, heads_list, rels_list):
+                results[i] = (heads, self.labels[rels])
+        return results
+
+
+def load(path, **overrides):
+    # overrides replace stored options, e.g. predict_batch or external_embedding.
+    parser = bundle.load(path, MSTParserLSTM, **overrides)
+    parser.InitExternal()
+    return Parser(parser)
@@ -0,0 +1,85 @@
+from optparse import OptionParser
+from itertools import product
+import numpy as np
+import decoder
+
+# Randomized equivalence check of the decoders: parse_proj_fast and parse_proj_batch
+# against parse_proj, and parse_nonproj against a brute-force maximum spanning tree,
+# with and without cost augmentation. Trees may only differ on exact score ties.
+
+
+def tree_score(scores, heads, gold=None):
+    augmented = decoder.cost_augment(scores, gold).astype(np.float64)
+    return sum(augmented[heads[m], m] for m in xrange(1, len(heads)))
+
+
+def is_tree(heads):
+    for m in xrange(1, len(heads)):
+        seen, x = set(), m
+        while x != 0:
+            if x in seen:
+                return False
+            seen.add(x)
+            x = heads[x]
+    return True
+
+
+def brute_force_mst(scores, gold=None):
+    # Best tree over all head assignments; only feasible for a handful of words.
+    n = len(scores) - 1
+    best, best_heads = -np.inf, None
+    for assignment in product(xrange(n + 1), repeat=n):
+        heads = [-1] + list(assignment)
+        if any(heads[m] == m for m in xrange(1, n + 1)) or not is_tree(heads):
+            continue
+        score = tree_score(scores, heads, gold)
+        if score > best:
+            best, best_heads = score, heads
+    return best_heads
+
+
+def random_gold(n):
+    # A random tree: every word attaches to the root or to an earlier word of a random order.
+    order = np.random.permutation(np.arange(1, n + 1))
+    heads = [-1] * (n + 1)
+    for i, m in enumerate(order):
+        heads[m] = 0 if i == 0 else int(order[np.random.randint(i)])
+    return heads
+
+
+def check(name, expected, got, scores, gold):
+    if expected != got and abs(tree_score(scores, expected, gold) - tree_score(scores, got, gold)) > 1e-4:
+        raise AssertionError('%s differs for n=%d%s:\n%s\n%s' % (name, len(scores) - 1, ' with gold' if gold is not None else '', expected, got))
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--trials", type="int", dest="trials", default=200)
+    parser.add_option("--max-words", type="int", dest="max_words", default=30)
+    parser.add_option("--max-brute-words", type="int", dest="max_brute_words", default=5)
+    parser.add_option("--seed", type="int", dest="seed", default=1)
+
+    (options, args) = parser.parse_args()
+    np.random.seed(options.seed)
+
+    for augment in (False, True):
+        scores_list, golds = [], []
+        for trial in xrange(options.trials):
+            n = np.random.randint(1, options.max_words + 1)
+            scores = np.random.randn(n + 1, n + 1).astype(np.float32)
+            gold = random_gold(n) if augment else None
+            expected = decoder.parse_proj(scores, gold)
+            check('parse_proj_fast', expected, decoder.parse_proj_fast(scores, gold), scores, gold)
+            scores_list.append(scores)
+            golds.append(gold)
+
+        for scores, gold, heads in zip(scores_list, golds, decoder.parse_proj_batch(scores_list, golds if augment else None)):
+            check('parse_proj_batch', decoder.parse_proj(scores, gold), heads, scores, gold)
+
+        for trial in xrange(options.trials):
+            n = np.random.randint(1, options.max_brute_words + 1)
+            scores = np.random.randn(n + 1, n + 1).astype(np.float32)
+            gold = random_gold(n) if augment else None
+            check('parse_nonproj', brute_force_mst(scores, gold), decoder.parse_nonproj(scores, gold), scores, gold)
+
+        print 'Decoders agree on', options.trials, 'random sentences per decoder', 'with' if augment else 'without', 'cost augmentation.'
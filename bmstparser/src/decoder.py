@@ -3,7 +3,7 @@
 
 import numpy as np
 import sys
-from collections import defaultdict, namedtuple
+from collections import OrderedDict, defaultdict, namedtuple
 from operator import itemgetter
 
 
@@ -103,3 +103,290 @@ def backtrack_eisner(incomplete_backtrack, complete_backtrack, s, t, direction,
             backtrack_eisner(incomplete_backtrack, complete_backtrack, r+1, t, 0, 1, heads)
             return
 
+
+def cost_augment(scores, gold=None):
+    '''
+    Add the Hamming cost used by cost-augmented decoding as a (NW+1)-by-(NW+1) matrix:
+    every arc h->m that is not in the gold tree gets +1.
+    '''
+    augmented = np.array(scores, dtype=np.float32) + np.float32(1.0)
+    if gold is not None:
+        gold = np.asarray(gold)
+        mods = np.arange(1, len(gold))
+        mods = mods[gold[mods] >= 0]
+        augmented[gold[mods], mods] -= np.float32(1.0)
+    return augmented
+
+
+def parse_proj_fast(scores, gold=None):
+    '''
+    Parse using Eisner's algorithm, processing all spans of the same width at once.
+    Returns the same trees as parse_proj.
+    '''
+    nr, nc = np.shape(scores)
+    if nr != nc:
+        raise ValueError("scores must be a squared matrix with nw+1 rows")
+
+    N = nr - 1 # Number of words (excluding root).
+    arcs = cost_augment(scores, gold)[None] # arcs[0, h, m]
+    complete_backtrack, incomplete_backtrack = _eisner_charts(arcs, _new_charts(1, N))
+
+    heads = [-1 for _ in range(N+1)]
+    backtrack_eisner_iter(incomplete_backtrack[:, 0], complete_backtrack[:, 0], 0, N, heads)
+
+    return heads
+
+
+# Chart buffers by padded length, oldest first, holding at most _chart_pool_bytes.
+_chart_pool = OrderedDict()
+_chart_pool_bytes = 256 * 1024 * 1024
+
+def parse_proj_batch(scores_list, golds=None, bucket_width=8, max_batch=64):
+    '''
+    Parse several sentences with Eisner's algorithm at once.
+    Sentences are grouped into buckets of similar length, their score matrices are
+    padded into one (B, L+1, L+1) tensor and each bucket is decoded together.
+    Chart buffers are kept in a pool bounded by size and reused across calls.
+    Returns a list of heads in the order of scores_list.
+    '''
+    lengths = [np.shape(scores)[0] - 1 for scores in scores_list]
+    order = sorted(xrange(len(scores_list)), key=lambda i: lengths[i])
+    results = [None] * len(scores_list)
+
+    while order:
+        L = -(-lengths[order[0]] // bucket_width) * bucket_width
+        bucket = [i for i in order[:max_batch] if lengths[i] <= L]
+        order = order[len(bucket):]
+
+        arcs = np.zeros([len(bucket), L+1, L+1], dtype=np.float32)
+        for b, i in enumerate(bucket):
+            n = lengths[i] + 1
+            arcs[b, :n, :n] = cost_augment(scores_list[i], golds[i] if golds is not None else None)
+
+        charts = _pooled_charts(len(bucket), L)
+        complete_backtrack, incomplete_backtrack = _eisner_charts(arcs, charts)
+
+        for b, i in enumerate(bucket):
+            N = lengths[i]
+            heads = [-1 for _ in range(N+1)]
+            backtrack_eisner_iter(incomplete_backtrack[:, b], complete_backtrack[:, b], 0, N, heads)
+            results[i] = heads
+
+    return results
+
+
+def _pooled_charts(B, N):
+    '''
+    Charts for B sentences of up to N words. A pooled set is grown to B sentences when
+    it is too small; the oldest sets are dropped to keep the pool within its byte limit,
+    and sets larger than the limit are not pooled at all.
+    '''
+    charts = _chart_pool.pop(N, None)
+    if charts is None or charts[0].shape[1] < B:
+        charts = _new_charts(B, N)
+    nbytes = sum(chart.nbytes for chart in charts)
+    while _chart_pool and sum(chart.nbytes for pooled in _chart_pool.itervalues() for chart in pooled) + nbytes > _chart_pool_bytes:
+        _chart_pool.popitem(last=False)
+    if nbytes <= _chart_pool_bytes:
+        _chart_pool[N] = charts
+    return [chart[:, :B] for chart in charts]
+
+
+def _new_charts(B, N):
+    '''
+    Allocate complete/incomplete charts and their backpointers for B sentences of up
+    to N words, indexed by direction (right=1), sentence, s, t.
+    '''
+    btype = np.int16 if N < np.iinfo(np.int16).max else np.int32
+    return (np.zeros([2, B, N+1, N+1], dtype=np.float32), np.zeros([2, B, N+1, N+1], dtype=np.float32),
+            -np.ones([2, B, N+1, N+1], dtype=btype), -np.ones([2, B, N+1, N+1], dtype=btype))
+
+
+def _eisner_charts(arcs, charts):
+    '''
+    Fill the Eisner charts for a (B, N+1, N+1) tensor of arc scores, one span width at a time.
+    Every cell with s < t is overwritten and the diagonal is never written, so pooled
+    charts can be reused without clearing. Returns the two backpointer charts.
+    '''
+    complete, incomplete, complete_backtrack, incomplete_backtrack = charts
+    B, N = arcs.shape[0], arcs.shape[1] - 1
+    bi = np.arange(B)[:, None]
+
+    for k in xrange(1, N+1):
+        s = np.arange(N-k+1)
+        t = s + k
+        r = s[:, None] + np.arange(k)[None, :] # split points s <= r < t
+        sr, tr = s[:, None], t[:, None]
+
+        # First, create incomplete items.
+        span_vals = complete[1][:, sr, r] + complete[0][:, r+1, tr]
+        vals = span_vals + arcs[:, t, s][:, :, None] # left tree
+        best = np.argmax(vals, axis=2)
+        incomplete[0][:, s, t] = vals[bi, s, best]
+        incomplete_backtrack[0][:, s, t] = s + best
+        vals = span_vals + arcs[:, s, t][:, :, None] # right tree
+        best = np.argmax(vals, axis=2)
+        incomplete[1][:, s, t] = vals[bi, s, best]
+        incomplete_backtrack[1][:, s, t] = s + best
+
+        # Second, create complete items.
+        vals = complete[0][:, sr, r] + incomplete[0][:, r, tr] # left tree
+        best = np.argmax(vals, axis=2)
+        complete[0][:, s, t] = vals[bi, s, best]
+        complete_backtrack[0][:, s, t] = s + best
+        vals = incomplete[1][:, sr, r+1] + complete[1][:, r+1, tr] # right tree
+        best = np.argmax(vals, axis=2)
+        complete[1][:, s, t] = vals[bi, s, best]
+        complete_backtrack[1][:, s, t] = s + 1 + best
+
+    return complete_backtrack, incomplete_backtrack
+
+
+def parse_nonproj(scores, gold=None):
+    '''
+    Parse using the Chu-Liu/Edmonds maximum spanning arborescence algorithm.
+    Follows Tarjan's path-growing variant for dense graphs: each word picks its best
+    incoming arc until a cycle closes, the cycle is contracted in O(n) per member, and
+    the contraction tree is expanded at the end, for O(n^2) overall.
+    A contracted cycle takes over the row and column of one of its members, so memory is
+    one (NW+1)-by-(NW+1) float64 matrix and two int32 ones, 16 bytes per arc, plus O(NW)
+    bookkeeping for the at most NW contraction nodes.
+    '''
+    nr, nc = np.shape(scores)
+    if nr != nc:
+        raise ValueError("scores must be a squared matrix with nw+1 rows")
+
+    N = nr - 1 # Number of words (excluding root).
+    M = nr + N # Node ids: every word plus one node per contraction.
+    rows = np.arange(nr)
+
+    # weights[u, v] is the best arc between the nodes holding rows u and v, whose original
+    # endpoints are arc_head[u, v] -> arc_mod[u, v].
+    weights = np.array(cost_augment(scores, gold), dtype=np.float64)
+    weights[:, 0] = -np.inf
+    weights[rows, rows] = -np.inf
+    arc_head = np.repeat(rows[:, None].astype(np.int32), nr, axis=1)
+    arc_mod = np.repeat(rows[None, :].astype(np.int32), nr, axis=0)
+    row_of = np.concatenate([rows, -np.ones(N, dtype=int)]) # Row of every node id.
+    node_at = rows.copy() # Node id holding every row.
+
+    in_weight = np.zeros(M)
+    in_arc = {}
+    parent = -np.ones(M, dtype=int)
+    children = {}
+    state = np.zeros(M, dtype=np.int8) # 0 unvisited, 1 on the current path, 2 done.
+    state[0] = 2
+    next_node = nr
+
+    for start in xrange(1, nr):
+        if state[start] != 0:
+            continue
+
+        path = [start]
+        state[start] = 1
+        v = start
+        while True:
+            r = row_of[v]
+            w = int(np.argmax(weights[:, r]))
+            u = node_at[w]
+            in_arc[v] = (arc_head[w, r], arc_mod[w, r])
+            in_weight[v] = weights[w, r]
+
+            if state[u] == 2:
+                state[path] = 2
+                break
+            if state[u] == 0:
+                state[u] = 1
+                path.append(u)
+                v = u
+                continue
+
+            # Contract the cycle u -> ... -> v into a new node c, which takes over the row
+            # and column of the cycle's first member.
+            cycle = path[path.index(u):]
+            del path[len(path) - len(cycle):]
+            cycle = np.array(cycle)
+            members = row_of[cycle]
+            c = next_node
+            next_node += 1
+
+            reduced = weights[:, members] - in_weight[cycle][None, :]
+            best = members[np.argmax(reduced, axis=1)]
+            in_weights = np.max(reduced, axis=1)
+            in_heads = arc_head[rows, best]
+            in_mods = arc_mod[rows, best]
+
+            best = members[np.argmax(weights[members, :], axis=0)]
+            out_weights = weights[best, rows]
+            out_heads = arc_head[best, rows]
+            out_mods = arc_mod[best, rows]
+
+            # Arcs inside the cycle disappear with it.
+            in_weights[members] = -np.inf
+            out_weights[members] = -np.inf
+            weights[members, :] = -np.inf
+            weights[:, members] = -np.inf
+
+            r = members[0]
+            weights[:, r], arc_head[:, r], arc_mod[:, r] = in_weights, in_heads, in_mods
+            weights[r, :], arc_head[r, :], arc_mod[r, :] = out_weights, out_heads, out_mods
+            weights[r, r] = -np.inf
+            row_of[c] = r
+            node_at[r] = c
+            parent[cycle] = c
+            children[c] = cycle
+
+            state[c] = 1
+            path.append(c)
+            v = c
+
+    # Expand: a super-node entered at original word m hands its arc down to the members
+    # containing m, every other cycle member keeps its own incoming arc.
+    heads = [-1 for _ in range(N+1)]
+    stack = [v for v in xrange(1, next_node) if parent[v] == -1]
+    while stack:
+        v = stack.pop()
+        h, m = in_arc[v]
+        heads[m] = int(h)
+        x = m
+        while x != v:
+            stack.extend(sibling for sibling in children[parent[x]] if sibling != x)
+            x = parent[x]
+
+    return heads
+
+
+def parse_nonproj_batch(scores_list, golds=None):
+    '''
+    Parse several sentences with parse_nonproj; mirrors parse_proj_batch.
+    '''
+    return [parse_nonproj(scores, golds[i] if golds is not None else None) for i, scores in enumerate(scores_list)]
+
+
+def backtrack_eisner_iter(incomplete_backtrack, complete_backtrack, s, t, heads):
+    '''
+    Non-recursive version of backtrack_eisner for the direction-major backpointers of one
+    sentence, so long sentences do not hit the interpreter recursion limit.
+    Starts from the complete right span (s, t).
+    '''
+    stack = [(s, t, 1, 1)]
+    while stack:
+        s, t, direction, complete = stack.pop()
+        if s == t:
+            continue
+        if complete:
+            r = int(complete_backtrack[direction, s, t])
+            if direction == 0:
+                stack.append((r, t, 0, 0))
+                stack.append((s, r, 0, 1))
+            else:
+                stack.append((r, t, 1, 1))
+                stack.append((s, r, 1, 0))
+        else:
+            r = int(incomplete_backtrack[direction, s, t])
+            if direction == 0:
+                heads[s] = t
+            else:
+                heads[t] = s
+            stack.append((r+1, t, 0, 1))
+            stack.append((s, r, 1, 1))
@@ -1,7 +1,8 @@
 from dynet import *
 from utils import read_conll, write_conll
-from operator import itemgetter
-import utils, time, random, decoder
+from encoder import BiLSTMEncoder
+from itertools import islice
+import utils, os, time, random, decoder
 import numpy as np
 
 
@@ -13,11 +14,23 @@ class MSTParserLSTM:
 
         self.activations = {'tanh': tanh, 'sigmoid': logistic, 'relu': rectify, 'tanh3': (lambda x: tanh(cwise_multiply(cwise_multiply(x, x), x)))}
         self.activation = self.activations[options.activation]
+        self.npactivations = {'tanh': np.tanh, 'sigmoid': (lambda x: 1.0 / (1.0 + np.exp(-x))), 'relu': (lambda x: np.maximum(x, 0.0)), 'tanh3': (lambda x: np.tanh(x * x * x))}
+        self.npactivation = self.npactivations[options.activation]
 
         self.blstmFlag = options.blstmFlag
         self.labelsFlag = options.labelsFlag
         self.costaugFlag = options.costaugFlag
         self.bibiFlag = options.bibiFlag
+        self.predictBatch = getattr(options, 'predict_batch', 1)
+        # Batches read and indexed ahead of the one being parsed or trained on.
+        self.prefetch = getattr(options, 'prefetch', 4)
+        self.timer = utils.StageTimer()
+        self.batchSize = getattr(options, 'batch_size', 1)
+
+        if getattr(options, 'decoder', 'eisner') == 'cle':
+            self.decode, self.decodeBatch = decoder.parse_nonproj, decoder.parse_nonproj_batch
+        else:
+            self.decode, self.decodeBatch = decoder.parse_proj_fast, decoder.parse_proj_batch
 
         self.ldims = options.lstm_dims
         self.wdims = options.wembedding_dims
@@ -32,18 +45,25 @@ class MSTParserLSTM:
 
 
         self.external_embedding, self.edim = None, 0
+        self.extrnIndex, self.extrnRows = None, None
         if options.external_embedding is not None:
-            external_embedding_fp = open(options.external_embedding,'r')
-            external_embedding_fp.readline()
-            self.external_embedding = {line.split(' ')[0] : [float(f) for f in line.strip().split(' ')[1:]] for line in external_embedding_fp}
-            external_embedding_fp.close()
-
-            self.edim = len(self.external_embedding.values()[0])
+            if getattr(options, 'extrn_words', None) is None:
+                self.external_embedding, vectors = utils.load_embeddings(options.external_embedding)
+            else:
+                # elookup holds the given words only. For a vocabulary-restricted model,
+                # Predict finds the other words through the on-disk index of the embedding
+                # file. Without the file (e.g. a bundle), the rows are loaded with the model.
+                self.external_embedding, vectors = options.extrn_words, None
+                if getattr(options, 'extrnRestrict', False) and os.path.exists(options.external_embedding):
+                    self.extrnIndex = utils.EmbeddingIndex(options.external_embedding)
+                    vectors = self.extrnIndex.vectors[[self.extrnIndex.row(word) for word in self.external_embedding]]
+
+            self.edim = vectors.shape[1] if vectors is not None else options.extrn_dims
             self.noextrn = [0.0 for _ in xrange(self.edim)]
             self.extrnd = {word: i + 3 for i, word in enumerate(self.external_embedding)}
             self.elookup = self.model.add_lookup_parameters((len(self.external_embedding) + 3, self.edim))
-            for word, i in self.extrnd.iteritems():
-                self.elookup.init_row(i, self.external_embedding[word])
+            if vectors is not None:
+                self.elookup.init_from_array(np.concatenate([[self.elookup.row_as_array(i) for i in xrange(3)], vectors]))
             self.extrnd['*PAD*'] = 1
             self.extrnd['*INITIAL*'] = 2
 
@@ -74,6 +94,9 @@ class MSTParserLSTM:
         self.plookup = self.model.add_lookup_parameters((len(pos) + 3, self.pdims))
         self.rlookup = self.model.add_lookup_parameters((len(rels), self.rdims))
 
+        lookups = [lookup for lookup, dims in [(self.wlookup, self.wdims), (self.plookup, self.pdims), (getattr(self, 'elookup', None), self.edim)] if dims > 0]
+        self.encoder = BiLSTMEncoder(lookups, self.builders if self.blstmFlag else None, self.bbuilders if self.blstmFlag and self.bibiFlag else None, backwardFirst=True)
+
         self.hidLayerFOH = self.model.add_parameters((self.hidden_units, self.ldims * 2))
         self.hidLayerFOM = self.model.add_parameters((self.hidden_units, self.ldims * 2))
         self.hidBias = self.model.add_parameters((self.hidden_units))
@@ -95,40 +118,61 @@ class MSTParserLSTM:
             self.routBias = self.model.add_parameters((len(self.irels)))
 
 
-    def  __getExpr(self, sentence, i, j, train):
+    def __evaluate(self, lstms, train):
+        # Score the whole n x n grid of (head, modifier) arcs as one expression;
+        # output[i, j] is the score of head i and modifier j.
+        n = lstms.dim()[0][1]
+        headfov = reshape(self.hidLayerFOH.expr() * lstms, (self.hidden_units, n, 1))
+        modfov = reshape(self.hidLayerFOM.expr() * lstms, (self.hidden_units, 1, n))
+        hidden = self.activation(headfov + modfov + reshape(self.hidBias.expr(), (self.hidden_units, 1, 1)))
+        hidden = reshape(hidden, (self.hidden_units, n * n))
+
+        if self.hidden2_units > 0:
+            hidden = self.activation(self.hid2Layer.expr() * hidden + self.hid2Bias.expr())
+
+        output = reshape(self.outLayer.expr() * hidden, (n, n)) # + self.outBias
+        scores = output.npvalue()
+
+        return scores, output
+
 
-        if sentence[i].headfov is None:
-            sentence[i].headfov = self.hidLayerFOH.expr() * concatenate([sentence[i].lstms[0], sentence[i].lstms[1]])
-        if sentence[j].modfov is None:
-            sentence[j].modfov  = self.hidLayerFOM.expr() * concatenate([sentence[j].lstms[0], sentence[j].lstms[1]])
+    def __evaluateNumeric(self, hvals, mvals):
+        # Same scores as __evaluate from the values of the head and modifier projections;
+        # the n x n grid is computed in NumPy, so training builds no graph for it.
+        n = hvals.shape[1]
+        hidden = self.npactivation(hvals[:, :, None] + mvals[:, None, :] + self.hidBias.as_array()[:, None, None])
+        hidden = hidden.reshape(self.hidden_units, n * n)
 
         if self.hidden2_units > 0:
-            output = self.outLayer.expr() * self.activation(self.hid2Bias.expr() + self.hid2Layer.expr() * self.activation(sentence[i].headfov + sentence[j].modfov + self.hidBias.expr())) # + self.outBias
-        else:
-            output = self.outLayer.expr() * self.activation(sentence[i].headfov + sentence[j].modfov + self.hidBias.expr()) # + self.outBias
+            hidden = self.npactivation(self.hid2Layer.as_array().dot(hidden) + self.hid2Bias.as_array()[:, None])
+
+        return self.outLayer.as_array().dot(hidden).reshape(n, n)
 
-        return output
 
+    def __arcExprs(self, headfov, modfov, heads, modifiers):
+        # Differentiable scores of the arcs heads[c] -> modifiers[c], one per column.
+        hidden = self.activation(select_cols(headfov, heads) + select_cols(modfov, modifiers) + self.hidBias.expr())
 
-    def __evaluate(self, sentence, train):
-        exprs = [ [self.__getExpr(sentence, i, j, train) for j in xrange(len(sentence))] for i in xrange(len(sentence)) ]
-        scores = np.array([ [output.scalar_value() for output in exprsRow] for exprsRow in exprs ])
+        if self.hidden2_units > 0:
+            hidden = self.activation(self.hid2Layer.expr() * hidden + self.hid2Bias.expr())
 
-        return scores, exprs
+        return self.outLayer.expr() * hidden
 
 
-    def __evaluateLabel(self, sentence, i, j):
-        if sentence[i].rheadfov is None:
-            sentence[i].rheadfov = self.rhidLayerFOH.expr() * concatenate([sentence[i].lstms[0], sentence[i].lstms[1]])
-        if sentence[j].rmodfov is None:
-            sentence[j].rmodfov  = self.rhidLayerFOM.expr() * concatenate([sentence[j].lstms[0], sentence[j].lstms[1]])
+    def __evaluateLabels(self, lstms_list, heads_list):
+        # Score the labels of every arc heads[m] -> m (m > 0) of all sentences at once;
+        # column c of output holds the label scores of the c-th arc.
+        headvecs = concatenate_cols([select_cols(lstms, [int(head) for head in heads[1:]]) for lstms, heads in zip(lstms_list, heads_list)])
+        modvecs = concatenate_cols([select_cols(lstms, range(1, len(heads))) for lstms, heads in zip(lstms_list, heads_list)])
+        hidden = self.activation(self.rhidLayerFOH.expr() * headvecs + self.rhidLayerFOM.expr() * modvecs + self.rhidBias.expr())
 
         if self.hidden2_units > 0:
-            output = self.routLayer.expr() * self.activation(self.rhid2Bias.expr() + self.rhid2Layer.expr() * self.activation(sentence[i].rheadfov + sentence[j].rmodfov + self.rhidBias.expr())) + self.routBias.expr()
-        else:
-            output = self.routLayer.expr() * self.activation(sentence[i].rheadfov + sentence[j].rmodfov + self.rhidBias.expr()) + self.routBias.expr()
+            hidden = self.activation(self.rhid2Layer.expr() * hidden + self.rhid2Bias.expr())
+
+        output = self.routLayer.expr() * hidden + self.routBias.expr()
+        scores = output.npvalue().reshape(len(self.irels), -1)
 
-        return output.value(), output
+        return scores, output
 
 
     def Save(self, filename):
@@ -139,186 +183,219 @@ class MSTParserLSTM:
         self.model.load(filename)
 
 
-    def Predict(self, conll_path):
-        with open(conll_path, 'r') as conllFP:
-            for iSentence, sentence in enumerate(read_conll(conllFP)):
-                conll_sentence = [entry for entry in sentence if isinstance(entry, utils.ConllEntry)]
+    def __indices(self, words, pos, extrn, keep):
+        # Lookup indices (one column per embedding table) and keep probabilities of the
+        # tokens of a sentence. In training a word is replaced by the unknown index with
+        # probability 1 - keep, and its external embedding only in half of those cases.
+        indices, probs = [], []
+        if self.wdims > 0:
+            indices.append(words)
+            probs.append(keep)
+        if self.pdims > 0:
+            indices.append(pos)
+            probs.append(np.ones(len(pos)))
+        if self.external_embedding is not None:
+            indices.append(extrn)
+            probs.append(0.5 + 0.5 * np.asarray(keep))
+        return np.array(indices).T, np.array(probs).T
 
-                for entry in conll_sentence:
-                    wordvec = self.wlookup[int(self.vocab.get(entry.norm, 0))] if self.wdims > 0 else None
-                    posvec = self.plookup[int(self.pos[entry.pos])] if self.pdims > 0 else None
-                    evec = self.elookup[int(self.extrnd.get(entry.form, self.extrnd.get(entry.norm, 0)))] if self.external_embedding is not None else None
-                    entry.vec = concatenate(filter(None, [wordvec, posvec, evec]))
 
-                    entry.lstms = [entry.vec, entry.vec]
-                    entry.headfov = None
-                    entry.modfov = None
+    def __encode(self, indices_list, keep_list=None, lookups=None):
+        # BiLSTM states of every sentence as (2 * ldims) x n matrices.
+        lstms_list = self.encoder.encode(indices_list, keep_list, lookups)
+        if not self.blstmFlag:
+            lstms_list = [concatenate([vecs, vecs]) for vecs in lstms_list]
 
-                    entry.rheadfov = None
-                    entry.rmodfov = None
+        return lstms_list
 
-                if self.blstmFlag:
-                    lstm_forward = self.builders[0].initial_state()
-                    lstm_backward = self.builders[1].initial_state()
 
-                    for entry, rentry in zip(conll_sentence, reversed(conll_sentence)):
-                        lstm_forward = lstm_forward.add_input(entry.vec)
-                        lstm_backward = lstm_backward.add_input(rentry.vec)
+    def __extrn(self, form, norm):
+        if self.extrnRows is not None:
+            return self.extrnRows.get(form, norm)
+        return self.extrnd.get(form, self.extrnd.get(norm, 0))
 
-                        entry.lstms[1] = lstm_forward.output()
-                        rentry.lstms[0] = lstm_backward.output()
 
-                    if self.bibiFlag:
-                        for entry in conll_sentence:
-                            entry.vec = concatenate(entry.lstms)
+    def InitExternal(self):
+        # Words missing from a restricted elookup get rows as the input needs them; called
+        # before parsing with the current parameter values.
+        self.extrnRows = utils.ExternalRows(self.extrnd, self.elookup.as_array(), self.extrnIndex) if self.extrnIndex is not None else None
 
-                        blstm_forward = self.bbuilders[0].initial_state()
-                        blstm_backward = self.bbuilders[1].initial_state()
 
-                        for entry, rentry in zip(conll_sentence, reversed(conll_sentence)):
-                            blstm_forward = blstm_forward.add_input(entry.vec)
-                            blstm_backward = blstm_backward.add_input(rentry.vec)
+    def Indices(self, forms, tags):
+        # Lookup indices of a sentence given the forms and POS tags of its words.
+        forms = ['*root*'] + list(forms)
+        norms = [utils.normalize(form) for form in forms]
+        tags = ['ROOT-POS'] + [tag.upper() for tag in tags]
+        return self.__indices([self.vocab.get(norm, 0) for norm in norms],
+                              [self.pos.get(tag, 0) for tag in tags],
+                              [self.__extrn(form, norm) for form, norm in zip(forms, norms)] if self.external_embedding is not None else None,
+                              np.ones(len(forms)))[0]
 
-                            entry.lstms[1] = blstm_forward.output()
-                            rentry.lstms[0] = blstm_backward.output()
 
-                scores, exprs = self.__evaluate(conll_sentence, True)
-                heads = decoder.parse_proj(scores)
+    def Parse(self, indices_list):
+        # Heads (0 is the root) and relation indices (-1 without labels) of the words of
+        # every sentence, given as Indices arrays.
+        if not indices_list:
+            return [], []
 
-                for entry, head in zip(conll_sentence, heads):
-                    entry.pred_parent_id = head
-                    entry.pred_relation = '_'
+        lstms_list = self.__encode(indices_list, lookups=self.encoder.lookups[:-1] + [self.extrnRows.matrix] if self.extrnRows is not None else None)
+        scores_list = [self.__evaluate(lstms, True)[0] for lstms in lstms_list]
 
-                dump = False
+        heads_list = self.decodeBatch(scores_list)
+        labels_list = [-np.ones(len(heads) - 1, dtype=np.int64) for heads in heads_list]
 
-                if self.labelsFlag:
-                    for modifier, head in enumerate(heads[1:]):
-                        scores, exprs = self.__evaluateLabel(conll_sentence, head, modifier+1)
-                        conll_sentence[modifier+1].pred_relation = self.irels[max(enumerate(scores), key=itemgetter(1))[0]]
+        if self.labelsFlag:
+            rscores, rexprs = self.__evaluateLabels(lstms_list, heads_list)
+            labels = np.argmax(rscores, axis=0)
+            offsets = np.cumsum([0] + [len(heads) - 1 for heads in heads_list])
+            labels_list = [labels[offsets[i]:offsets[i + 1]] for i in xrange(len(heads_list))]
 
-                renew_cg()
-                if not dump:
-                    yield sentence
+        renew_cg()
+        return [np.asarray(heads[1:]) for heads in heads_list], labels_list
 
 
-    def Train(self, conll_path):
-        errors = 0
-        batch = 0
-        eloss = 0.0
-        mloss = 0.0
-        eerrors = 0
-        etotal = 0
-        start = time.time()
+    def Predict(self, conll_path):
+        self.InitExternal()
 
         with open(conll_path, 'r') as conllFP:
-            shuffledData = list(read_conll(conllFP))
-            random.shuffle(shuffledData)
+            for parsed in self.PredictSentences(read_conll(conllFP)):
+                yield parsed
 
-            errs = []
-            lerrs = []
-            eeloss = 0.0
-
-            for iSentence, sentence in enumerate(shuffledData):
-                if iSentence % 100 == 0 and iSentence != 0:
-                    print 'Processing sentence number:', iSentence, 'Loss:', eloss / etotal, 'Errors:', (float(eerrors)) / etotal, 'Time', time.time()-start
-                    start = time.time()
-                    eerrors = 0
-                    eloss = 0.0
-                    etotal = 0
-                    lerrors = 0
-                    ltotal = 0
-
-                conll_sentence = [entry for entry in sentence if isinstance(entry, utils.ConllEntry)]
-
-                for entry in conll_sentence:
-                    c = float(self.wordsCount.get(entry.norm, 0))
-                    dropFlag = (random.random() < (c/(0.25+c)))
-                    wordvec = self.wlookup[int(self.vocab.get(entry.norm, 0)) if dropFlag else 0] if self.wdims > 0 else None
-                    posvec = self.plookup[int(self.pos[entry.pos])] if self.pdims > 0 else None
-                    evec = None
-
-                    if self.external_embedding is not None:
-                        evec = self.elookup[self.extrnd.get(entry.form, self.extrnd.get(entry.norm, 0)) if (dropFlag or (random.random() < 0.5)) else 0]
-                    entry.vec = concatenate(filter(None, [wordvec, posvec, evec]))
-
-                    entry.lstms = [entry.vec, entry.vec]
-                    entry.headfov = None
-                    entry.modfov = None
-
-                    entry.rheadfov = None
-                    entry.rmodfov = None
-
-                if self.blstmFlag:
-                    lstm_forward = self.builders[0].initial_state()
-                    lstm_backward = self.builders[1].initial_state()
-
-                    for entry, rentry in zip(conll_sentence, reversed(conll_sentence)):
-                        lstm_forward = lstm_forward.add_input(entry.vec)
-                        lstm_backward = lstm_backward.add_input(rentry.vec)
-
-                        entry.lstms[1] = lstm_forward.output()
-                        rentry.lstms[0] = lstm_backward.output()
-
-                    if self.bibiFlag:
-                        for entry in conll_sentence:
-                            entry.vec = concatenate(entry.lstms)
-
-                        blstm_forward = self.bbuilders[0].initial_state()
-                        blstm_backward = self.bbuilders[1].initial_state()
-
-                        for entry, rentry in zip(conll_sentence, reversed(conll_sentence)):
-                            blstm_forward = blstm_forward.add_input(entry.vec)
-                            blstm_backward = blstm_backward.add_input(rentry.vec)
-
-                            entry.lstms[1] = blstm_forward.output()
-                            rentry.lstms[0] = blstm_backward.output()
-
-                scores, exprs = self.__evaluate(conll_sentence, True)
-                gold = [entry.parent_id for entry in conll_sentence]
-                heads = decoder.parse_proj(scores, gold if self.costaugFlag else None)
-
-                if self.labelsFlag:
-                    for modifier, head in enumerate(gold[1:]):
-                        rscores, rexprs = self.__evaluateLabel(conll_sentence, head, modifier+1)
-                        goldLabelInd = self.rels[conll_sentence[modifier+1].relation]
-                        wrongLabelInd = max(((l, scr) for l, scr in enumerate(rscores) if l != goldLabelInd), key=itemgetter(1))[0]
-                        if rscores[goldLabelInd] < rscores[wrongLabelInd] + 1:
-                            lerrs.append(rexprs[wrongLabelInd] - rexprs[goldLabelInd])
-
-                e = sum([1 for h, g in zip(heads[1:], gold[1:]) if h != g])
-                eerrors += e
-                if e > 0:
-                    loss = [(exprs[h][i] - exprs[g][i]) for i, (h,g) in enumerate(zip(heads, gold)) if h != g] # * (1.0/float(e))
-                    eloss += (e)
-                    mloss += (e)
-                    errs.extend(loss)
 
-                etotal += len(conll_sentence)
+    def PredictSentences(self, sentences):
+        # Parse read_conll sentences in batches of predictBatch, filling their predictions.
+        # The next batches are read and indexed on a background thread meanwhile.
+        for batch, indices_list, done in utils.prefetch(self.__indexBatches(sentences), self.prefetch, self.timer):
+            ts = time.time()
+            self.__predictBatch(batch, indices_list)
+            self.timer.add('parse', time.time() - ts)
+            for sentence in done:
+                yield sentence
 
-                if iSentence % 1 == 0 or len(errs) > 0 or len(lerrs) > 0:
-                    eeloss = 0.0
 
-                    if len(errs) > 0 or len(lerrs) > 0:
-                        eerrs = (esum(errs + lerrs)) #* (1.0/(float(len(errs))))
-                        eerrs.scalar_value()
-                        eerrs.backward()
-                        self.trainer.update()
-                        errs = []
-                        lerrs = []
+    def __indexBatches(self, sentences, pool=8):
+        # Sentences are read in pools of pool batches and batched by length within a pool,
+        # so that little padding is encoded. The last batch of a pool comes with all the
+        # sentences of the pool, in input order, to be yielded once it is parsed.
+        sentences = iter(sentences)
+        while True:
+            pooled = list(islice(sentences, self.predictBatch * pool))
+            if not pooled:
+                break
+            order = sorted(pooled, key=len)
+            batches = [order[i:i + self.predictBatch] for i in xrange(0, len(order), self.predictBatch)]
+            for b, batch in enumerate(batches):
+                yield batch, self.__batchIndices(batch), pooled if b == len(batches) - 1 else []
 
-                    renew_cg()
 
-        if len(errs) > 0:
-            eerrs = (esum(errs + lerrs)) #* (1.0/(float(len(errs))))
-            eerrs.scalar_value()
-            eerrs.backward()
-            self.trainer.update()
+    def __batchIndices(self, batch):
+        conll_sentences = [[entry for entry in sentence if isinstance(entry, utils.ConllEntry)][1:] for sentence in batch]
+        return [self.Indices([entry.form for entry in conll_sentence], [entry.pos for entry in conll_sentence]) for conll_sentence in conll_sentences]
+
+
+    def __predictBatch(self, batch, indices_list):
+        conll_sentences = [[entry for entry in sentence if isinstance(entry, utils.ConllEntry)][1:] for sentence in batch]
+        heads_list, labels_list = self.Parse(indices_list)
+
+        for conll_sentence, heads, labels in zip(conll_sentences, heads_list, labels_list):
+            for entry, head, label in zip(conll_sentence, heads, labels):
+                entry.pred_parent_id = head
+                entry.pred_relation = self.irels[label] if label >= 0 else '_'
+
+
+    def Train(self, corpus):
+        mloss = 0.0
+        eloss = 0.0
+        eerrors = 0
+        etotal = 0
+        iSentence = 0
+        start = time.time()
+
+        # External embedding rows of the distinct word forms of the corpus.
+        extrn = np.array([self.extrnd.get(form, self.extrnd.get(utils.normalize(form), 0)) for form in corpus.forms]) if self.external_embedding is not None else None
+
+        self.timer.reset()
+        batches = utils.length_buckets(corpus.lengths(), self.batchSize)
+        for spans, indices_list, keep_list in utils.prefetch(self.__trainBatches(corpus, batches, extrn), self.prefetch, self.timer):
+            ts = time.time()
+            if iSentence // 100 != (iSentence + len(spans)) // 100 and etotal > 0:
+                elapsed = time.time()-start
+                print 'Processing sentence number:', iSentence, 'Loss:', eloss / etotal, 'Errors:', (float(eerrors)) / etotal, 'Time', elapsed, 'Words/sec', etotal / elapsed
+                start = time.time()
+                eerrors = 0
+                eloss = 0.0
+                etotal = 0
+            iSentence += len(spans)
+
+            lstms_list = self.__encode(indices_list, keep_list)
+            lstms = concatenate_cols(lstms_list)
+            headfov = self.hidLayerFOH.expr() * lstms
+            modfov = self.hidLayerFOM.expr() * lstms
+            hvals, mvals = headfov.npvalue(), modfov.npvalue()
 
             errs = []
             lerrs = []
-            eeloss = 0.0
+            wrongHeads, wrongMods, goldHeads = [], [], []
+            golds = []
+            offset = 0
+
+            for span in spans:
+                gold = corpus.head[span].tolist()
+                n = len(gold)
+                scores = self.__evaluateNumeric(hvals[:, offset:offset+n], mvals[:, offset:offset+n])
+                heads = self.decode(scores, gold if self.costaugFlag else None)
+                golds.append(gold)
+
+                # Only the predicted-but-wrong and the matching gold arcs enter the graph.
+                wrong = [i for i, (h,g) in enumerate(zip(heads, gold)) if h != g]
+                wrongHeads.extend(offset + heads[i] for i in wrong)
+                goldHeads.extend(offset + gold[i] for i in wrong)
+                wrongMods.extend(offset + i for i in wrong)
+
+                e = len(wrong)
+                eerrors += e
+                eloss += (e)
+                mloss += (e)
+                etotal += n
+                offset += n
+
+            if wrongMods:
+                e = len(wrongMods)
+                arcs = self.__arcExprs(headfov, modfov, wrongHeads + goldHeads, wrongMods + wrongMods)
+                errs.append(dot_product(reshape(arcs, (2 * e,)), inputVector([1.0] * e + [-1.0] * e))) # * (1.0/float(e))
+
+            if self.labelsFlag:
+                rscores, rexprs = self.__evaluateLabels(lstms_list, golds)
+                arcs = np.arange(rscores.shape[1])
+                goldLabels = np.concatenate([corpus.rel[span][1:] for span in spans])
+                wrongScores = rscores.copy()
+                wrongScores[goldLabels, arcs] = -np.inf
+                wrongLabels = np.argmax(wrongScores, axis=0)
+                violated = rscores[goldLabels, arcs] < rscores[wrongLabels, arcs] + 1
+                if violated.any():
+                    # Hinge loss of all violated arcs as one expression: +wrong - gold.
+                    margins = np.zeros(rscores.shape)
+                    margins[wrongLabels[violated], arcs[violated]] += 1.0
+                    margins[goldLabels[violated], arcs[violated]] -= 1.0
+                    lerrs.append(sum_elems(cwise_multiply(rexprs, inputTensor(margins))))
+
+            if len(errs) > 0 or len(lerrs) > 0:
+                eerrs = (esum(errs + lerrs)) #* (1.0/(float(len(errs))))
+                eerrs.scalar_value()
+                eerrs.backward()
+                self.trainer.update()
 
             renew_cg()
+            self.timer.add('train', time.time() - ts)
 
         self.trainer.update_epoch()
         print "Loss: ", mloss/iSentence
+        print 'Stage times:', self.timer
+
+
+    def __trainBatches(self, corpus, batches, extrn):
+        # Spans, lookup indices and keep probabilities of the sentences of every batch.
+        for batch in batches:
+            spans = [corpus.span(i) for i in batch]
+            indices_list, keep_list = zip(*[self.__indices(corpus.word[span], corpus.pos[span], extrn[corpus.form[span]] if extrn is not None else None, corpus.keep[span]) for span in spans])
+            yield spans, indices_list, keep_list
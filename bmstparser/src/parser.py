@@ -1,5 +1,20 @@
 from optparse import OptionParser
-import pickle, utils, mstlstm, os, os.path, time
+import pickle, utils, mstlstm, bundle, multiprocessing, os, os.path, time, sys
+
+
+def predictChunk(sentences):
+    # Runs in a worker forked after the model was loaded, on its copy-on-write parser.
+    return list(parser.PredictSentences(sentences))
+
+
+def predict(parser, sentences, pool, options):
+    # Parsed sentences in input order. With a pool of workers the input is cut into chunks
+    # of about --chunk-tokens tokens, so that long and short sentences spread evenly, and
+    # only a few chunks per worker are in flight at a time.
+    if pool is None:
+        return parser.PredictSentences(sentences)
+    chunks = utils.ordered_map(pool, predictChunk, utils.prefetch(utils.token_chunks(sentences, options.chunk_tokens), options.prefetch, parser.timer), 2 * options.workers)
+    return (sentence for chunk in chunks for sentence in chunk)
 
 
 if __name__ == '__main__':
@@ -9,6 +24,8 @@ if __name__ == '__main__':
     parser.add_option("--test", dest="conll_test", help="Annotated CONLL test file", metavar="FILE", default="../data/en-universal-test.conll.ptb")
     parser.add_option("--extrn", dest="external_embedding", help="External embeddings", metavar="FILE")
     parser.add_option("--params", dest="params", help="Parameters file", metavar="FILE", default="params.pickle")
+    parser.add_option("--bundle", dest="bundle", help="Load a single-file model bundle instead of --model and --params", metavar="FILE")
+    parser.add_option("--save-bundle", action="store_true", dest="saveBundle", default=False)
     parser.add_option("--model", dest="model", help="Load/Save model file", metavar="FILE", default="neuralfirstorder.model")
     parser.add_option("--wembedding", type="int", dest="wembedding_dims", default=100)
     parser.add_option("--pembedding", type="int", dest="pembedding_dims", default=25)
@@ -24,41 +41,110 @@ if __name__ == '__main__':
     parser.add_option("--disableblstm", action="store_false", dest="blstmFlag", default=True)
     parser.add_option("--disablelabels", action="store_false", dest="labelsFlag", default=True)
     parser.add_option("--predict", action="store_true", dest="predictFlag", default=False)
+    parser.add_option("--preprocess", action="store_true", dest="preprocessFlag", default=False)
+    parser.add_option("--extrn-restrict", action="store_true", dest="extrnRestrict", default=False)
     parser.add_option("--bibi-lstm", action="store_true", dest="bibiFlag", default=False)
     parser.add_option("--disablecostaug", action="store_false", dest="costaugFlag", default=True)
+    parser.add_option("--decoder", type="choice", choices=["eisner", "cle"], dest="decoder", default=None, help="eisner (projective, the default) or cle (non-projective); when parsing, defaults to the model's decoder")
+    parser.add_option("--predict-batch", type="int", dest="predict_batch", default=32)
+    parser.add_option("--workers", type="int", dest="workers", help="Processes parsing the test file in parallel", default=1)
+    parser.add_option("--chunk-tokens", type="int", dest="chunk_tokens", help="Tokens per work unit of a parallel parse", default=2000)
+    parser.add_option("--prefetch", type="int", dest="prefetch", help="Batches read and indexed in the background, 0 to disable", default=4)
+    parser.add_option("--batch-size", type="int", dest="batch_size", default=1)
     parser.add_option("--dynet-seed", type="int", dest="seed", default=0)
     parser.add_option("--dynet-mem", type="int", dest="mem", default=0)
+    parser.add_option("--dynet-autobatch", type="int", dest="autobatch", default=0)
 
     (options, args) = parser.parse_args()
+    if options.predictFlag:
+        inputs = utils.conll_inputs([options.conll_test] + args)
+        if '-' in inputs:
+            # Parsed sentences go to stdout, everything else to stderr.
+            sys.stdout = sys.stderr
 
     print 'Using external embedding:', options.external_embedding
 
     if options.predictFlag:
-        with open(options.params, 'r') as paramsfp:
-            words, w2i, pos, rels, stored_opt = pickle.load(paramsfp)
+        overrides = {'predict_batch': options.predict_batch, 'prefetch': options.prefetch}
+        if options.decoder is not None:
+            overrides['decoder'] = options.decoder
+        if options.bundle is not None:
+            if options.external_embedding is not None:
+                overrides['external_embedding'] = options.external_embedding
+
+            print 'Loading lstm mstparser bundle:'
+            parser = bundle.load(options.bundle, mstlstm.MSTParserLSTM, **overrides)
+        else:
+            with open(options.params, 'r') as paramsfp:
+                words, w2i, pos, rels, stored_opt = pickle.load(paramsfp)
 
-        stored_opt.external_embedding = options.external_embedding
+            stored_opt.external_embedding = options.external_embedding
+            for name, value in overrides.iteritems():
+                setattr(stored_opt, name, value)
 
-        print 'Initializing lstm mstparser:'
-        parser = mstlstm.MSTParserLSTM(words, pos, rels, w2i, stored_opt)
+            print 'Initializing lstm mstparser:'
+            parser = mstlstm.MSTParserLSTM(words, pos, rels, w2i, stored_opt)
 
-        parser.Load(options.model)
-        conllu = (os.path.splitext(options.conll_test.lower())[1] == '.conllu')
-        tespath = os.path.join(options.output, 'test_pred.conll' if not conllu else 'test_pred.conllu')
+            parser.Load(options.model)
+        # A single plain file is parsed to test_pred.conll[u] in --outdir and evaluated;
+        # stdin, several files and gzip compressed files are streamed to stdout and mirrored
+        # paths under --outdir instead.
+        evaluate = len(inputs) == 1 and inputs[0] != '-' and not inputs[0].endswith('.gz')
+        if evaluate:
+            options.conll_test = inputs[0]
+            conllu = (os.path.splitext(options.conll_test.lower())[1] == '.conllu')
+            tespath = os.path.join(options.output, 'test_pred.conll' if not conllu else 'test_pred.conllu')
+            outputs = [tespath]
+        else:
+            outputs = utils.mirror_paths(inputs, options.output)
+            if any(os.path.abspath(inpath) == os.path.abspath(outpath) for inpath, outpath in zip(inputs, outputs) if inpath != '-'):
+                sys.exit('Outputs would overwrite inputs, choose another --outdir')
+
+        # Workers are forked only after the model and the external embeddings are loaded.
+        parser.InitExternal()
+        pool = multiprocessing.Pool(options.workers) if options.workers > 1 else None
 
+        parser.timer.reset()
         ts = time.time()
-        test_res = list(parser.Predict(options.conll_test))
+        for inpath, outpath in zip(inputs, outputs):
+            writer = utils.ConllWriter(outpath, timer=parser.timer)
+            with utils.open_conll(inpath) as conllFP:
+                for sentence in predict(parser, utils.read_conll(conllFP), pool, options):
+                    writer.write(sentence)
+            writer.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
         te = time.time()
+        print 'Stage times:', parser.timer
         print 'Finished predicting test.', te-ts, 'seconds.'
-        utils.write_conll(tespath, test_res)
 
-        if not conllu:
-            os.system('perl src/utils/eval.pl -g ' + options.conll_test + ' -s ' + tespath  + ' > ' + tespath + '.txt')
-        else:
-            os.system('python src/utils/evaluation_script/conll17_ud_eval.py -v -w src/utils/evaluation_script/weights.clas ' + options.conll_test + ' ' + tespath + ' > ' + testpath + '.txt')
+        if evaluate:
+            if not conllu:
+                os.system('perl src/utils/eval.pl -g ' + options.conll_test + ' -s ' + tespath  + ' > ' + tespath + '.txt')
+            else:
+                os.system('python src/utils/evaluation_script/conll17_ud_eval.py -v -w src/utils/evaluation_script/weights.clas ' + options.conll_test + ' ' + tespath + ' > ' + testpath + '.txt')
     else:
-        print 'Preparing vocab'
-        words, w2i, pos, rels = utils.vocab(options.conll_train)
+        if os.path.isdir(options.conll_train):
+            print 'Loading preprocessed corpus'
+            corpus = utils.Corpus.load(options.conll_train)
+            words, w2i, pos, rels = corpus.vocab
+        else:
+            print 'Preparing vocab'
+            words, w2i, pos, rels = utils.vocab(options.conll_train)
+            corpus = utils.index_corpus(options.conll_train, words, w2i, pos, rels)
+
+        if options.preprocessFlag:
+            corpuspath = os.path.join(options.output, os.path.basename(options.conll_train) + '.corpus')
+            corpus.save(corpuspath)
+            print 'Saved preprocessed corpus to', corpuspath
+            sys.exit()
+
+        if options.extrnRestrict and options.external_embedding is not None:
+            # Only words of the training data get external embedding rows in the model.
+            index = utils.EmbeddingIndex(options.external_embedding)
+            options.extrn_words = [word for word in sorted(set(str(form) for form in corpus.forms) | set(words)) if index.row(word) >= 0]
+            print 'Restricted external embedding to', len(options.extrn_words), 'words'
 
         with open(os.path.join(options.output, options.params), 'w') as paramsfp:
             pickle.dump((words, w2i, pos, rels, options), paramsfp)
@@ -69,11 +155,13 @@ if __name__ == '__main__':
 
         for epoch in xrange(options.epochs):
             print 'Starting epoch', epoch
-            parser.Train(options.conll_train)
+            parser.Train(corpus)
             conllu = (os.path.splitext(options.conll_dev.lower())[1] == '.conllu')
             devpath = os.path.join(options.output, 'dev_epoch_' + str(epoch+1) + ('.conll' if not conllu else '.conllu'))
             utils.write_conll(devpath, parser.Predict(options.conll_dev))
             parser.Save(os.path.join(options.output, os.path.basename(options.model) + str(epoch+1)))
+            if options.saveBundle:
+                bundle.save(os.path.join(options.output, os.path.basename(options.model) + str(epoch+1) + '.bundle'), parser, words, w2i, pos, rels, options)
 
             if not conllu:
                 os.system('perl src/utils/eval.pl -g ' + options.conll_dev  + ' -s ' + devpath  + ' > ' + devpath + '.txt')
@@ -0,0 +1,151 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+from collections import deque
+import Queue, json, threading, time
+import numpy as np
+import api
+
+
+class Batcher(threading.Thread):
+    '''
+    Owns the parser. It takes the next request, keeps collecting requests for up to window
+    seconds (or until max_sentences sentences are waiting), parses them all as one batch
+    and wakes every requester. Latencies of the last history requests are kept for stats.
+    '''
+    def __init__(self, parser, window, max_sentences, history=10000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.parser = parser
+        self.window = window
+        self.max_sentences = max_sentences
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=history)
+        self.requests = 0
+        self.batches = 0
+
+    def submit(self, sentences):
+        # Called from the request threads; blocks until the sentences are parsed.
+        request = {'sentences': sentences, 'done': threading.Event(), 'start': time.time()}
+        self.queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def run(self):
+        while True:
+            requests = [self.queue.get()]
+            size = len(requests[0]['sentences'])
+            deadline = time.time() + self.window
+            while size < self.max_sentences:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self.queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+                size += len(requests[-1]['sentences'])
+
+            try:
+                results = self.parser.parse([sentence for request in requests for sentence in request['sentences']])
+            except Exception as e:
+                results = None
+                for request in requests:
+                    request['error'] = e
+
+            offset = 0
+            for request in requests:
+                n = len(request['sentences'])
+                if results is not None:
+                    request['result'] = results[offset:offset + n]
+                offset += n
+                with self.lock:
+                    self.latencies.append(time.time() - request['start'])
+                    self.requests += 1
+                request['done'].set()
+
+            with self.lock:
+                self.batches += 1
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            stats = {'queue_depth': self.queue.qsize(), 'requests': self.requests, 'batches': self.batches}
+        if len(latencies):
+            stats['latency_ms'] = {'p50': np.percentile(latencies, 50), 'p90': np.percentile(latencies, 90), 'p99': np.percentile(latencies, 99)}
+        return stats
+
+
+class ParseHandler(BaseHTTPRequestHandler):
+    # POST /parse with {"sentences": [[[form, pos], ...], ...]} returns {"heads": [...],
+    # "labels": [...]} with one list per sentence; GET /stats returns the batcher stats.
+    def do_POST(self):
+        if self.path != '/parse':
+            self.send_error(404)
+            return
+
+        try:
+            sentences = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))['sentences']
+            sentences = [[(form.encode('utf-8'), pos.encode('utf-8')) for form, pos in sentence] for sentence in sentences]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_error(400, 'Expected {"sentences": [[[form, pos], ...], ...]}')
+            return
+
+        try:
+            results = self.server.batcher.submit(sentences)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        self.__reply({'heads': [heads.tolist() for heads, labels in results], 'labels': [labels.tolist() for heads, labels in results]})
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        self.__reply(self.server.batcher.stats())
+
+    def __reply(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ParseServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--bundle", dest="bundle", help="Model bundle", metavar="FILE")
+    parser.add_option("--extrn", dest="external_embedding", help="External embeddings", metavar="FILE")
+    parser.add_option("--host", type="string", dest="host", default="127.0.0.1")
+    parser.add_option("--port", type="int", dest="port", default=8000)
+    parser.add_option("--window", type="float", dest="window", help="Milliseconds to wait for more requests to batch", default=5.0)
+    parser.add_option("--max-batch", type="int", dest="max_batch", help="Sentences that end the wait early", default=256)
+    parser.add_option("--predict-batch", type="int", dest="predict_batch", default=32)
+    parser.add_option("--dynet-seed", type="int", dest="seed", default=7)
+    parser.add_option("--dynet-mem", type="int", dest="mem", default=512)
+
+    (options, args) = parser.parse_args()
+
+    overrides = {'predict_batch': options.predict_batch}
+    if options.external_embedding is not None:
+        overrides['external_embedding'] = options.external_embedding
+
+    batcher = Batcher(api.load(options.bundle, **overrides), options.window / 1000.0, options.max_batch)
+    batcher.start()
+
+    server = ParseServer((options.host, options.port), ParseHandler)
+    server.batcher = batcher
+    print 'Serving on', options.host, options.port
+    server.serve_forever()